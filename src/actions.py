@@ -20,10 +20,13 @@ import subprocess
 import shlex
 import os.path
 import sys
+import time
+import multiprocessing
 import yaml
 
 import loader
 import passman
+import passgen
 import diceware
 
 def load_config(filename=None):
@@ -46,7 +49,13 @@ def load_loader(conf):
     if conf["db"]["format"] == "gpg":
         return loader.GPGLoader()
     elif conf["db"]["format"] == "aes":
-        return loader.AESLoader()
+        backend = loader.get_aes_backend(conf["db"].get("aes_backend"))
+        serializer = loader.get_serializer(conf["db"].get("serializer"))
+        return loader.AESLoader(backend, serializer)
+    elif conf["db"]["format"] == "chunked":
+        backend = loader.get_aes_backend(conf["db"].get("aes_backend"))
+        return loader.ChunkedLoader(backend,
+                                    conf["db"].get("block_size", 1000))
     elif conf["db"]["format"] == "yaml":
         return loader.YAMLLoader()
     else:
@@ -70,36 +79,158 @@ def create_database(conf):
     conf["database"] = passman.PasswordManager(conf["symbols_dir"])
 
 
+def get_journal(conf, loader):
+    """Get the journal of the password database (None if the loader
+    doesn't support journals)."""
+    if "journal" not in conf:
+        conf["journal"] = loader.open_journal(conf["db"]["filename"])
+    return conf["journal"]
+
+
+def check_database(conf):
+    """Check that the password database file exists."""
+    filename = conf["db"]["filename"]
+    if not os.path.exists(filename):
+        raise ValueError("password database does not exist")
+    if os.path.isdir(filename):
+        raise ValueError("password database is not a regular file")
+
+
+def check_fingerprints(conf):
+    """Warn about the entries whose generator has changed."""
+    for e in conf["database"].check_fingerprints():
+        sys.stderr.write("Warning: the generator {} of entry {} has " \
+                         "changed.\n".format(e.generator, e.name))
+
+
 def load_database(conf, loader):
-    """Load the password database."""
+    """Load the password database and replay its journal. A partial
+    database (see load_selection) is loaded again entirely. The
+    database is not modified: the missing generator fingerprints are
+    only recorded when it is saved (see save_database)."""
+    if conf.pop("partial_database", False):
+        del conf["database"]
     if "database" not in conf:
-        filename = conf["db"]["filename"]
-        if not os.path.exists(filename):
-            raise ValueError("password database does not exist")
-        if os.path.isdir(filename):
-            raise ValueError("password database is not a regular file")
+        check_database(conf)
         passphrase = get_password(conf)
         entries = loader.load(conf["db"]["filename"], passphrase)
         create_database(conf)
-        conf["database"].passwords = entries
-        conf["database"].compute_tags()
+        conf["database"].set_entries(entries)
+        journal = get_journal(conf, loader)
+        if journal:
+            conf["database"].replay(journal.load(passphrase))
+            if "journal_ratio" in conf["db"]:
+                conf["database"].start_journal()
+        check_fingerprints(conf)
+
+
+def load_selection(conf, loader, tag=None, query=None, fuzzy=None,
+                   limit=10):
+    """Load the part of the password database needed to select entries
+    with a tag, a query or a fuzzy query (with *limit* matches) when
+    the loader has an index of the fields used by the selection (see
+    loader.ChunkedLoader). The database is then partial: it must not
+    be modified (load_database loads it again entirely). Otherwise (or
+    if the database has a journal) the whole database is loaded."""
+    if "database" in conf or not loader.index_fields:
+        return load_database(conf, loader)
+    if fuzzy:
+        fields = set(["name", "username"])
+    elif query:
+        fields = passman.Query(query).get_fields()
+    elif tag:
+        fields = set(["tags"])
+    else:
+        fields = None
+    journal = get_journal(conf, loader)
+    if fields is None or not fields <= loader.index_fields or \
+       (journal and os.path.exists(journal.journal_filename)):
+        return load_database(conf, loader)
+
+    def select(entries):
+        database = passman.PasswordManager(conf["symbols_dir"])
+        database.set_entries(entries)
+        if fuzzy:
+            return database.fuzzy_find(fuzzy, limit)
+        elif query:
+            return database.query(query)
+        return database.get_entries(tag)
+
+    check_database(conf)
+    passphrase = get_password(conf)
+    entries = loader.load_selection(conf["db"]["filename"], passphrase,
+                                    select)
+    create_database(conf)
+    conf["database"].set_entries(entries)
+    conf["partial_database"] = True
+    check_fingerprints(conf)
 
 
 def save_database(conf, loader):
-    """Save the password database."""
+    """Save the password database. If the journal is enabled (i.e.
+    if journal_ratio is set), the changes are appended to it and the
+    database is only saved again (compacting the journal) when the
+    size of the journal exceeds journal_ratio times the size of the
+    database. A partial database (see load_selection) is not saved:
+    it can't have been modified. The missing generator fingerprints
+    are recorded first."""
+    if conf.get("partial_database"):
+        return
     passphrase = get_password(conf)
-    loader.save(conf["database"].passwords,
-                conf["db"]["filename"], passphrase)
-
-
-def list_entries(conf, filter=None, tag=None, verbose=False,
-                 print_entropy=False):
-    """List entries of a password database.
+    database = conf["database"]
+    database.record_fingerprints()
+    filename = conf["db"]["filename"]
+    ratio = conf["db"].get("journal_ratio")
+    journal = get_journal(conf, loader)
+    if ratio is not None and journal and journal.digest and \
+       database.journal is not None:
+        if database.journal:
+            journal.append(database.journal, passphrase)
+            database.start_journal()
+        if journal.size <= ratio * os.path.getsize(filename):
+            return
+    loader.save(database.passwords, filename, passphrase)
+    if journal:
+        journal.reset()
+        if ratio is not None:
+            database.start_journal()
+
+
+def migrate(conf, loader, format=None, serializer=None, filename=None):
+    """Save the password database in another format
+    - *conf* is a configuration dict
+    - *loader* is the loader of the current database
+    - *format* is the new format (if None, the current one)
+    - *serializer* is the new serializer (if None, the current one)
+    - *filename* is the new file name (if None, the database is
+      replaced)"""
+    load_database(conf, loader)
+    db = dict(conf["db"])
+    if format:
+        db["format"] = format
+    if serializer:
+        db["serializer"] = serializer
+    if filename:
+        db["filename"] = os.path.expanduser(filename)
+    new_conf = dict(conf)
+    new_conf["db"] = db
+    new_conf.pop("journal", None)
+    save_database(new_conf, load_loader(new_conf))
+
+
+def select_entries(conf, filter=None, tag=None, query=None):
+    """Returns the entries of a password database selected by a query,
+    a filter or a tag.
     - *conf* is a configuration dict
     - *filter* is an optional non empty list of regexp
     - *tag* is a tag (not used if filter is given)
-    - *verbose* and *print_entropy* are booleans flag"""
-    if filter:
+    - *query* is an optional query (filter and tag are not used if it
+      is given, see passman.Query)"""
+    if query:
+        if not isinstance(query, basestring):
+            raise TypeError, "query must be a string"
+        entries = conf["database"].query(query)
+    elif filter:
         if type(filter) != list:
             raise TypeError, "filter must be a list of regexp"
         entries = conf["database"].filter(filter)
@@ -107,6 +238,24 @@ def list_entries(conf, filter=None, tag=None, verbose=False,
         if tag and not isinstance(tag, basestring):
             raise TypeError, "tag must be a string"
         entries = conf["database"].get_entries(tag)
+    return entries
+
+
+def list_entries(conf, filter=None, tag=None, verbose=False,
+                 print_entropy=False, fuzzy=None, limit=10, query=None):
+    """List entries of a password database.
+    - *conf* is a configuration dict
+    - *filter* is an optional non empty list of regexp
+    - *tag* is a tag (not used if filter is given)
+    - *verbose* and *print_entropy* are booleans flag
+    - *fuzzy* is an optional fuzzy query (filter and tag are not used
+      if it is given), the *limit* best matches are listed
+    - *query* is an optional query (filter and tag are not used if it
+      is given, see passman.Query)"""
+    if fuzzy:
+        entries = conf["database"].fuzzy_find(fuzzy, limit)
+    else:
+        entries = select_entries(conf, filter, tag, query)
 
     if verbose:
         print "i) name (generator): username [(nonce)]: " + \
@@ -123,9 +272,26 @@ def list_entries(conf, filter=None, tag=None, verbose=False,
             print s
 
 
+def list_tags(conf):
+    """List the tags of a password database with their number of
+    entries.
+    - *conf* is a configuration dict"""
+    counts = conf["database"].get_tag_counts()
+    for t in sorted(counts):
+        print "{} ({})".format(t, counts[t])
+
+
+def get_generator_manager(conf):
+    """Returns the generator manager of the database if it has been
+    loaded or a new one otherwise."""
+    if "database" in conf:
+        return conf["database"].generator_manager
+    return passgen.GeneratorManager(conf["symbols_dir"])
+
+
 def get_entropy_length(conf, generator, entropy, length):
     if entropy:
-        manager = conf["database"].generator_manager
+        manager = get_generator_manager(conf)
         generator_inst = manager.get_generator(generator)
         return max(generator_inst.get_minimum_length(entropy), length)
     elif length:
@@ -157,22 +323,16 @@ def add(conf, name, username, comment="", nonce="",
     entry.get_password(conf["database"].generator_manager, "")
 
 
-def remove(conf, filter=None, tag=None):
+def remove(conf, filter=None, tag=None, query=None):
     """Remove a set of entries from a password database
     - *conf* is a configuration dict
     - *filter* is an optional non empty list of regexp
-    - *tag* is a tag (not used if filter is given)"""
-    if filter:
-        if type(filter) != list:
-            raise TypeError, "filter must be a list of regexp"
-        entries = conf["database"].filter(filter)
-    else:
-        if tag and not isinstance(tag, basestring):
-            raise TypeError, "tag must be a string"
-        entries = conf["database"].get_entries(tag)
+    - *tag* is a tag (not used if filter is given)
+    - *query* is an optional query (filter and tag are not used if it
+      is given, see passman.Query)"""
+    entries = select_entries(conf, filter, tag, query)
 
-    for e in entries:
-        conf["database"].remove_entry(e)
+    conf["database"].remove_entries(entries)
 
 
 def add_tag(conf, filter=None, tag=None):
@@ -230,27 +390,91 @@ def gen_password(conf, entry, clipboard=False, verbose=False):
 
 
 def password(conf, filter=None, tag=None, index=0,
-             clipboard=False, verbose=False):
+             clipboard=False, verbose=False, fuzzy=None, query=None):
     """Get the password of an entry
     - *conf* is a configuration dict
     - *filter* is an optional non empty list of regexp
     - *tag* is a tag (not used if filter is given)
     - *index* the index of the entry in the set of entries
     - *clipboard* if True will store password in clipboard
-    - *verbose* verbose mode if True"""
-    if filter:
-        if type(filter) != list:
-            raise TypeError, "filter must be a list of regexp"
-        entries = conf["database"].filter(filter)
+    - *verbose* verbose mode if True
+    - *fuzzy* is an optional fuzzy query (filter and tag are not used
+      if it is given), entries are then ranked best match first
+    - *query* is an optional query (filter and tag are not used if it
+      is given, see passman.Query)"""
+    if fuzzy:
+        entries = conf["database"].fuzzy_find(fuzzy, index + 1)
     else:
-        if tag and not isinstance(tag, basestring):
-            raise TypeError, "tag must be a string"
-        entries = conf["database"].get_entries(tag)
+        entries = select_entries(conf, filter, tag, query)
 
     entry = entries[index]
     gen_password(conf, entry, clipboard, verbose)
 
 
+def _init_export_worker(symbols_dir, passphrase):
+    """Initializes an export worker process with its own
+    PasswordManager (used for its GeneratorManager) and the master
+    passphrase."""
+    global _export_worker
+    _export_worker = (passman.PasswordManager(symbols_dir), passphrase)
+
+
+def _export_chunk(entries):
+    """Derives the passwords of a list of entries in an export worker
+    process and returns a list of (name, username, password)."""
+    manager, passphrase = _export_worker
+    return [(e.name, e.username, p)
+            for e, p in manager.derive_all(passphrase, entries)]
+
+
+def export(conf, filter=None, tag=None, output=None, processes=None,
+           chunksize=256):
+    """Derives the password of a set of entries and writes them (one
+    tab-separated name, username and password per line) to a stream.
+    - *conf* is a configuration dict
+    - *filter* is an optional non empty list of regexp
+    - *tag* is a tag (not used if filter is given)
+    - *output* is the output filename (stdout if None)
+    - *processes* is the number of worker processes (number of CPUs if
+      None)
+    - *chunksize* is the number of entries sent at once to a worker
+    The throughput is reported on stderr when done."""
+    entries = select_entries(conf, filter, tag)
+
+    prompt = "Please enter the master passphrase: "
+    passphrase = getpass.getpass(prompt)
+    chunks = [entries[i:i + chunksize]
+              for i in xrange(0, len(entries), chunksize)]
+    if output:
+        # The passwords are only readable by the user (even if the
+        # file already exists)
+        fd = os.open(output, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        os.fchmod(fd, 0600)
+        out = os.fdopen(fd, 'w')
+    else:
+        out = sys.stdout
+    start = time.time()
+    pool = multiprocessing.Pool(processes, _init_export_worker,
+                                (conf["symbols_dir"], passphrase))
+    try:
+        for results in pool.imap(_export_chunk, chunks):
+            for result in results:
+                out.write("\t".join(result) + "\n")
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        if output:
+            out.close()
+    elapsed = time.time() - start
+    rate = len(entries) / elapsed if elapsed > 0 else float("inf")
+    sys.stderr.write("Exported {} passwords in {:.2f}s " \
+                     "({:.0f} passwords/s)\n".format(len(entries),
+                                                    elapsed, rate))
+
+
 def quick_password(conf, generator, name, username, comment, nonce,
                    length, entropy, clipboard=False, verbose=False):
     """Make an entry (without saving it) and generates a password
@@ -273,28 +497,56 @@ def quick_password(conf, generator, name, username, comment, nonce,
 
 
 def generate(conf, generator, length=0, entropy=0,
-             clipboard=False, verbose=False):
-    """Generate a password
+             clipboard=False, verbose=False, n=1, vectorized=False):
+    """Generate passwords (the database doesn't need to be loaded)
     - *conf* is a configuration dict
     - *generator* is the generator (if None, retrieved from configuration)
     - *length* is the minimum length (if 0, retrieved from configuration)
     - *clipboard* if True will store password in clipboard
-    - *verbose* if True verbose mode"""
-    manager = conf["database"].generator_manager
+    - *verbose* if True verbose mode
+    - *n* is the number of passwords to generate
+    - *vectorized* if True uses NumPy (if available) to generate the
+      passwords"""
+    manager = get_generator_manager(conf)
     generator_name = generator if generator else conf["default_generator"]
     generator = manager.get_generator(generator_name)
 
-    length = get_entropy_length(conf, generator, entropy, length)
+    length = get_entropy_length(conf, generator_name, entropy, length)
     entropy = generator.get_entropy(length)
-    password = generator.get_random_password(length)
+    if vectorized:
+        passwords = generator.get_vectorized_random_passwords(n, length)
+    else:
+        passwords = generator.get_random_passwords(n, length)
     if verbose:
         print "Random password of length {} (entropy={}):".format(length,
                                                                   entropy)
 
     if clipboard:
-        copy2clipboard(conf, password)
+        copy2clipboard(conf, "\n".join(passwords))
     else:
-        print password
+        for password in passwords:
+            sys.stdout.write(password + "\n")
+
+
+def calibrate(conf, target=100, hash_name="sha512", symbols=None,
+              verbose=False):
+    """Benchmarks PBKDF2 on this machine and prints the name of a
+    PBKDF2 generator deriving a password in about target milliseconds.
+    - *conf* is a configuration dict
+    - *target* is the target derivation time in milliseconds
+    - *hash_name* is the hash algorithm used by PBKDF2
+    - *symbols* is the symbols file name (if None, retrieved from the
+      default generator of the configuration)
+    - *verbose* verbose mode if True"""
+    if not symbols:
+        default_generator = conf["default_generator"]
+        symbols = default_generator.split(":")[1] \
+                  if ":" in default_generator else "ascii"
+    iterations = passgen.calibrate_pbkdf2(hash_name, target / 1000.)
+    if verbose:
+        print "{} iterations of PBKDF2 with {} in about {} ms:".format(
+            iterations, hash_name, target)
+    print "pbkdf2-{}-{}:{}".format(hash_name, iterations, symbols)
 
 
 def make_diceware(src_filename, n, min_length, out_filename=None):
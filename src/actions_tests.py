@@ -16,8 +16,10 @@
 # along with PassMAN.  If not, see <http://www.gnu.org/licenses/>.
 
 import unittest
+import os
 
 import actions
+import passman
 
 class TestActions(unittest.TestCase):
     def setUp(self):
@@ -65,5 +67,39 @@ class TestActions(unittest.TestCase):
     def test_generate(self):
         self.assertTrue(False)
 
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        with open("test_symbols", 'w') as f:
+            f.write("\n".join([chr(33 + i) for i in xrange(94)]))
+        self.conf = {"symbols_dir": "."}
+        actions.create_database(self.conf)
+        for i in xrange(5):
+            entry = passman.PasswordEntry("sha512:test_symbols",
+                                          "name{}".format(i), "user")
+            self.conf["database"].set_entry(entry)
+        self.getpass = actions.getpass.getpass
+        actions.getpass.getpass = lambda prompt: "passphrase"
+
+    def tearDown(self):
+        actions.getpass.getpass = self.getpass
+        for filename in ["test_symbols", "test_symbols.sym", "test_export"]:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def test_export(self):
+        with open("test_export", 'w') as f:
+            f.write("old content\n" * 100)
+        os.chmod("test_export", 0644)
+        actions.export(self.conf, output="test_export", processes=2,
+                       chunksize=2)
+        self.assertEqual(os.stat("test_export").st_mode & 0777, 0600)
+        manager = self.conf["database"].generator_manager
+        with open("test_export") as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines, ["\t".join([e.name, e.username,
+                                            e.get_password(manager,
+                                                           "passphrase")])
+                                 for e in self.conf["database"].passwords])
+
 if __name__ == '__main__':
     unittest.main()
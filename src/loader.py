@@ -19,31 +19,602 @@ import yaml
 import subprocess
 import shlex
 import bz2
+import os
+import shutil
+import tempfile
+import hashlib
+import struct
+import StringIO
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    from cryptography.hazmat.backends import default_backend
+except ImportError:
+    Cipher = None
+try:
+    from Crypto.Cipher import AES
+except ImportError:
+    AES = None
+
+import passman
+import symbols
 
 class CodingError(Exception):
     """Exceptions raised when an error occured during encoding or
     decoding entries."""
     pass
 
+OPENSSL_CMD = shlex.split("openssl aes-256-cbc -salt " +
+                          "-pass env:PASSMAN_PASSPHRASE")
+SALT_MAGIC = "Salted__"
+BZ2_MAGIC = "BZh"
+# Digests used by EVP_BytesToKey in OpenSSL >= 1.1.0 and before.
+DIGESTS = [hashlib.sha256, hashlib.md5]
+
+def openssl_env(passphrase):
+    """Returns the environment of an OpenSSL process reading the
+    passphrase from the PASSMAN_PASSPHRASE variable."""
+    env = dict(os.environ)
+    env["PASSMAN_PASSPHRASE"] = encode_passphrase(passphrase)
+    return env
+
+def encode_passphrase(passphrase):
+    """Returns the passphrase as a byte string."""
+    if passphrase is None:
+        return ""
+    if isinstance(passphrase, unicode):
+        return passphrase.encode("utf-8")
+    return passphrase
+
+def evp_bytes_to_key(passphrase, salt, digest, key_size=32, iv_size=16):
+    """Returns the (key, iv) tuple derived from the passphrase and the
+    salt like OpenSSL's EVP_BytesToKey (with one iteration)."""
+    passphrase = encode_passphrase(passphrase)
+    block = ""
+    data = ""
+    while len(data) < key_size + iv_size:
+        block = digest(block + passphrase + salt).digest()
+        data += block
+    return data[:key_size], data[key_size:key_size + iv_size]
+
+if getattr(yaml, "__with_libyaml__", False):
+    class CStreamLoader(yaml.cyaml.CParser, yaml.composer.Composer,
+                        yaml.constructor.FullConstructor,
+                        yaml.resolver.Resolver):
+        """A YAML loader using libyaml's parser. Unlike yaml.CLoader,
+        nodes are composed in Python so that yaml_load can compose
+        the items of the list one by one."""
+
+        def __init__(self, stream):
+            yaml.cyaml.CParser.__init__(self, stream)
+            yaml.composer.Composer.__init__(self)
+            yaml.constructor.FullConstructor.__init__(self)
+            yaml.resolver.Resolver.__init__(self)
+
+    class CStreamDumper(yaml.CDumper):
+        """A YAML dumper using libyaml's emitter. Unlike yaml.CDumper,
+        nodes are serialized in Python so that yaml_dump can
+        serialize the entries one by one."""
+
+        def __init__(self, stream, encoding=None):
+            yaml.CDumper.__init__(self, stream, encoding=encoding)
+            yaml.serializer.Serializer.__init__(self, encoding=encoding)
+
+    CStreamLoader.add_constructor(passman.PasswordEntry.yaml_tag,
+                                  passman.PasswordEntry.from_yaml)
+    CStreamDumper.add_representer(passman.PasswordEntry,
+                                  passman.PasswordEntry.to_yaml)
+    # Classes used to load and dump the entries.
+    YAMLLoaderClass = CStreamLoader
+    YAMLDumperClass = CStreamDumper
+else:
+    YAMLLoaderClass = getattr(yaml, "FullLoader", yaml.Loader)
+    YAMLDumperClass = yaml.Dumper
+
 def yaml_load(input):
-    entries = yaml.load(input)
+    """Loads the list of entries from a string or a stream (read by
+    blocks). The items of the list are composed and constructed one
+    by one so that the nodes of the whole document are never kept in
+    memory. The attributes missing from the entries saved by older
+    versions are set to their default value by
+    PasswordEntry.__setstate__."""
+    loader = YAMLLoaderClass(input)
+    try:
+        loader.get_event()
+        if loader.check_event(yaml.StreamEndEvent):
+            return None
+        loader.get_event()
+        if not loader.check_event(yaml.SequenceStartEvent):
+            node = loader.compose_node(None, None)
+            loader.get_event()
+            return loader.construct_document(node)
+        loader.get_event()
+        entries = []
+        while not loader.check_event(yaml.SequenceEndEvent):
+            node = loader.compose_node(None, None)
+            entries.append(loader.construct_document(node))
+        return entries
+    finally:
+        loader.dispose()
+
+def yaml_dump(entries, stream):
+    """Dumps a list of entries to a stream, like yaml.dump does, but
+    each entry is represented and serialized separately so that the
+    nodes of the whole document are never kept in memory."""
+    dumper = YAMLDumperClass(stream, encoding="utf-8")
+    try:
+        dumper.open()
+        dumper.emit(yaml.DocumentStartEvent(explicit=dumper.use_explicit_start,
+                                            version=dumper.use_version,
+                                            tags=dumper.use_tags))
+        dumper.emit(yaml.SequenceStartEvent(None, u"tag:yaml.org,2002:seq",
+                                            True, flow_style=False))
+        for e in entries:
+            node = dumper.represent_data(e)
+            dumper.anchor_node(node)
+            dumper.serialize_node(node, None, None)
+            dumper.represented_objects = {}
+            dumper.object_keeper = []
+            dumper.alias_key = None
+            dumper.serialized_nodes = {}
+            dumper.anchors = {}
+        dumper.emit(yaml.SequenceEndEvent())
+        dumper.emit(yaml.DocumentEndEvent(explicit=dumper.use_explicit_end))
+        dumper.close()
+    finally:
+        dumper.dispose()
+
+# Binary records format: a header (magic string with the version and
+# number of entries) followed by a record for each entry. A record is
+# its size followed by the length, a flags byte, the entropy, the
+# strings (see RECORD_STRINGS) and the number of tags followed by the
+# tags. Strings are UTF-8 encoded and prefixed by their size (or by
+# NULL_STRING for None). Readers ignore the end of a record they don't
+# know so that fields can be appended to the records.
+RECORDS_MAGIC = "PMREC001"
+RECORDS_HEADER = struct.Struct("<8sI")
+RECORD_SIZE = struct.Struct("<I")
+RECORD_FIELDS = struct.Struct("<iBd")
+STRING_SIZE = struct.Struct("<I")
+NULL_STRING = 0xffffffff
+HAS_ENTROPY = 1
+RECORD_STRINGS = ["generator", "name", "username", "comment", "nonce",
+                  "fingerprint"]
+
+def encode_string(s):
+    """Returns the size-prefixed UTF-8 encoding of a string."""
+    if s is None:
+        return STRING_SIZE.pack(NULL_STRING)
+    if isinstance(s, unicode):
+        s = s.encode("utf-8")
+    elif not isinstance(s, str):
+        s = str(s)
+    return STRING_SIZE.pack(len(s)) + s
+
+def decode_string(data, offset):
+    """Returns the string encoded at offset in data and the offset
+    following it. Like YAML, returns a str if the string is ASCII and
+    an unicode string otherwise."""
+    size, = STRING_SIZE.unpack_from(data, offset)
+    offset += STRING_SIZE.size
+    if size == NULL_STRING:
+        return None, offset
+    s = data[offset:offset + size]
+    if len(s) != size:
+        raise struct.error("string out of record")
+    try:
+        s.decode("ascii")
+    except UnicodeDecodeError:
+        s = s.decode("utf-8")
+    return s, offset + size
+
+def encode_strings(strings):
+    """Returns the encoding of a list of strings: the array of their
+    sizes (NULL_STRING for None) followed by the strings (UTF-8
+    encoded)."""
+    strings = [s.encode("utf-8") if isinstance(s, unicode) else s
+               for s in strings]
+    sizes = [NULL_STRING if s is None else len(s) for s in strings]
+    return struct.pack("<{}I".format(len(sizes)), *sizes) + \
+           "".join(s for s in strings if s is not None)
+
+def decode_strings(data, offset, n):
+    """Returns the list of n strings encoded at offset in data (see
+    encode_strings) and the offset following them."""
+    sizes = struct.unpack_from("<{}I".format(n), data, offset)
+    offset += STRING_SIZE.size * n
+    end = offset + sum(size for size in sizes if size != NULL_STRING)
+    if len(data) < end:
+        raise struct.error("strings out of data")
+    try:
+        data[offset:end].decode("ascii")
+        ascii = True
+    except UnicodeDecodeError:
+        ascii = False
+    strings = []
+    for size in sizes:
+        if size == NULL_STRING:
+            strings.append(None)
+            continue
+        s = data[offset:offset + size]
+        offset += size
+        if not ascii:
+            try:
+                s.decode("ascii")
+            except UnicodeDecodeError:
+                s = s.decode("utf-8")
+        strings.append(s)
+    return strings, offset
+
+def encode_record(entry):
+    """Returns the record of an entry."""
+    flags = HAS_ENTROPY if entry.entropy is not None else 0
+    fields = [RECORD_FIELDS.pack(entry.length, flags, entry.entropy or 0.)]
+    fields.extend(encode_string(getattr(entry, a)) for a in RECORD_STRINGS)
+    fields.append(STRING_SIZE.pack(len(entry.tags)))
+    fields.extend(encode_string(t) for t in sorted(entry.tags))
+    data = "".join(fields)
+    return RECORD_SIZE.pack(len(data)) + data
+
+def decode_record(data):
+    """Returns the entry of a record (without its size)."""
+    length, flags, entropy = RECORD_FIELDS.unpack_from(data)
+    offset = RECORD_FIELDS.size
+    strings = {}
+    for a in RECORD_STRINGS:
+        strings[a], offset = decode_string(data, offset)
+    n, = STRING_SIZE.unpack_from(data, offset)
+    offset += STRING_SIZE.size
+    tags = []
+    for i in xrange(n):
+        tag, offset = decode_string(data, offset)
+        tags.append(tag)
+    return passman.PasswordEntry(length=length, tags=tags,
+                                 entropy=entropy if flags & HAS_ENTROPY
+                                 else None, **strings)
+
+def records_dump(entries, stream):
+    """Dumps a list of entries to a stream using the records format."""
+    stream.write(RECORDS_HEADER.pack(RECORDS_MAGIC, len(entries)))
     for e in entries:
-        attr = e.__dict__
-        if "comment" not in attr:
-            e.comment = ""
-        if "nonce" not in attr:
-            e.nonce = ""
-        if "length" not in attr:
-            e.length = 1
-        if "entropy" not in attr:
-            e.entropy = None
-        if "tags" not in attr:
-            e.tags = set()
+        stream.write(encode_record(e))
+
+def records_load(stream, block=65536):
+    """Loads the list of entries from a stream (read by blocks) using
+    the records format. Raises a CodingError if the stream isn't a
+    valid records stream."""
+    data = stream.read(RECORDS_HEADER.size)
+    if len(data) != RECORDS_HEADER.size:
+        raise CodingError("Truncated records header")
+    magic, count = RECORDS_HEADER.unpack(data)
+    if magic != RECORDS_MAGIC:
+        raise CodingError("Not a records stream")
+    entries = []
+    data = ""
+    offset = 0
+    eof = False
+    while len(entries) < count:
+        if len(data) - offset >= RECORD_SIZE.size:
+            size, = RECORD_SIZE.unpack_from(data, offset)
+            start = offset + RECORD_SIZE.size
+            if len(data) >= start + size:
+                try:
+                    entries.append(decode_record(data[start:start + size]))
+                except struct.error:
+                    raise CodingError("Invalid record")
+                offset = start + size
+                continue
+        if eof:
+            raise CodingError("Truncated records stream")
+        more = stream.read(block)
+        eof = not more
+        data = data[offset:] + more
+        offset = 0
     return entries
 
+# Journal format (see Journal): a header (magic string and SHA-1
+# digest of the database file) followed by frames. A frame is its size
+# followed by the (encrypted) changes: the magic string followed by a
+# code and a body for each change. The body of a set change is a
+# record, the one of a remove change is the number of positions
+# followed by the positions, the one of a tags change is the position,
+# the number of tags and the tags and the one of a fingerprint change
+# is the position and the fingerprint.
+JOURNAL_MAGIC = "PMJRN001"
+JOURNAL_HEADER = struct.Struct("<8s20s")
+FRAME_SIZE = struct.Struct("<I")
+POSITION = struct.Struct("<I")
+CHANGE_CODES = {"set": "S", "remove": "R", "tags": "T",
+                "fingerprint": "F"}
+
+def encode_changes(changes):
+    """Returns the encoding of a list of changes recorded by a
+    PasswordManager. The entries of the set changes are encoded in
+    their current state."""
+    data = [JOURNAL_MAGIC]
+    for change in changes:
+        data.append(CHANGE_CODES[change[0]])
+        if change[0] == "set":
+            data.append(encode_record(change[1]))
+        elif change[0] == "remove":
+            data.append(POSITION.pack(len(change[1])))
+            data.extend(POSITION.pack(i) for i in change[1])
+        elif change[0] == "fingerprint":
+            data.append(POSITION.pack(change[1]))
+            data.append(encode_string(change[2]))
+        else:
+            data.append(POSITION.pack(change[1]))
+            data.append(STRING_SIZE.pack(len(change[2])))
+            data.extend(encode_string(t) for t in sorted(change[2]))
+    return "".join(data)
+
+def decode_changes(data):
+    """Returns the list of changes encoded in data. Raises a
+    CodingError if data is invalid."""
+    if not data.startswith(JOURNAL_MAGIC):
+        raise CodingError("Invalid journal frame")
+    changes = []
+    offset = len(JOURNAL_MAGIC)
+    try:
+        while offset < len(data):
+            code = data[offset]
+            offset += 1
+            if code == CHANGE_CODES["set"]:
+                size, = RECORD_SIZE.unpack_from(data, offset)
+                offset += RECORD_SIZE.size
+                record = data[offset:offset + size]
+                if len(record) != size:
+                    raise struct.error("record out of frame")
+                changes.append(("set", decode_record(record)))
+                offset += size
+            elif code == CHANGE_CODES["remove"]:
+                n, = POSITION.unpack_from(data, offset)
+                offset += POSITION.size
+                positions = struct.unpack_from("<{}I".format(n), data, offset)
+                changes.append(("remove", list(positions)))
+                offset += POSITION.size * n
+            elif code == CHANGE_CODES["tags"]:
+                i, n = struct.unpack_from("<2I", data, offset)
+                offset += POSITION.size + STRING_SIZE.size
+                tags = []
+                for j in xrange(n):
+                    tag, offset = decode_string(data, offset)
+                    tags.append(tag)
+                changes.append(("tags", i, tags))
+            elif code == CHANGE_CODES["fingerprint"]:
+                i, = POSITION.unpack_from(data, offset)
+                fingerprint, offset = decode_string(data,
+                                                    offset + POSITION.size)
+                changes.append(("fingerprint", i, fingerprint))
+            else:
+                raise CodingError("Unknown change code")
+    except struct.error:
+        raise CodingError("Invalid journal frame")
+    return changes
+
+class PrefixedReader:
+    """A PrefixedReader is a file-like object reading a prefix (that
+    has already been read from a stream) followed by the stream."""
+
+    def __init__(self, prefix, stream):
+        self.prefix = prefix
+        self.stream = stream
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.stream.read(size)
+        if size < 0:
+            data, self.prefix = self.prefix + self.stream.read(), ""
+        elif size > len(self.prefix):
+            data = self.prefix + self.stream.read(size - len(self.prefix))
+            self.prefix = ""
+        else:
+            data, self.prefix = self.prefix[:size], self.prefix[size:]
+        return data
+
+class Serializer:
+    """A Serializer dumps and loads lists of entries to and from
+    streams. Serializer is an abstract class. The streams of the
+    serializers having a magic string start with it."""
+    name = None
+    magic = None
+
+    def dump(self, entries, stream):
+        """Dumps a list of entries to a stream."""
+        raise NotImplementedError
+
+    def load(self, stream):
+        """Loads and returns a list of entries from a stream."""
+        raise NotImplementedError
+
+class YAMLSerializer(Serializer):
+    """A YAMLSerializer uses YAML (see yaml_dump and yaml_load)."""
+    name = "yaml"
+
+    def dump(self, entries, stream):
+        yaml_dump(entries, stream)
+
+    def load(self, stream):
+        return yaml_load(stream)
+
+class RecordsSerializer(Serializer):
+    """A RecordsSerializer uses the binary records format (see
+    records_dump and records_load)."""
+    name = "records"
+    magic = RECORDS_MAGIC
+
+    def dump(self, entries, stream):
+        records_dump(entries, stream)
+
+    def load(self, stream):
+        return records_load(stream)
+
+# Available serializers, the default one first.
+SERIALIZERS = [YAMLSerializer(), RecordsSerializer()]
+
+def get_serializer(name=None):
+    """Returns the serializer with the given name or the default one.
+    Raises a ValueError if the serializer is unknown."""
+    for serializer in SERIALIZERS:
+        if name is None or serializer.name == name:
+            return serializer
+    raise ValueError("Unknown serializer: {}".format(name))
+
+def load_entries(stream):
+    """Loads and returns a list of entries from a stream. The
+    serializer is detected using its magic string (YAML is used if
+    none matches)."""
+    size = max(len(s.magic) for s in SERIALIZERS if s.magic)
+    prefix = stream.read(size)
+    stream = PrefixedReader(prefix, stream)
+    for serializer in SERIALIZERS:
+        if serializer.magic and prefix.startswith(serializer.magic):
+            return serializer.load(stream)
+    return get_serializer("yaml").load(stream)
+
+class BZ2Reader:
+    """A BZ2Reader is a file-like object reading and decompressing a
+    bzip2 stream by blocks."""
+
+    def __init__(self, stream, block=65536):
+        self.stream = stream
+        self.block = block
+        self.decompressor = bz2.BZ2Decompressor()
+        self.buffer = ""
+        self.eof = False
+
+    def read(self, size=-1):
+        """Returns at most size decompressed bytes (all the remaining
+        ones if size is negative). Raises an IOError if the stream is
+        not a complete bzip2 stream."""
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            data = self.stream.read(self.block)
+            if not data:
+                self.eof = True
+                try:
+                    # Raises an EOFError only if the end of the bzip2
+                    # stream has been reached.
+                    self.decompressor.decompress("")
+                except EOFError:
+                    break
+                raise IOError("Truncated bzip2 stream")
+            try:
+                self.buffer += self.decompressor.decompress(data)
+            except EOFError:
+                # Trailing data after the end of the bzip2 stream.
+                self.eof = True
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+class BZ2Writer:
+    """A BZ2Writer is a file-like object compressing the data written
+    in it to a stream. It must be closed to end the bzip2 stream."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.compressor = bz2.BZ2Compressor()
+
+    def write(self, data):
+        data = self.compressor.compress(data)
+        if data:
+            self.stream.write(data)
+
+    def close(self):
+        self.stream.write(self.compressor.flush())
+
+class Journal:
+    """A Journal is an append-only file (next to a database file)
+    where the changes recorded by a PasswordManager since the
+    database file has been saved are appended. It starts with a
+    header holding the digest of the database file so that it is
+    ignored once the database file has been saved again. The changes
+    are appended as frames encrypted with an AES backend (if any)."""
+
+    def __init__(self, filename, backend=None):
+        """Initializes the journal of a database file. It must be
+        loaded (or reset) before appending changes."""
+        self.filename = filename
+        self.journal_filename = filename + ".journal"
+        self.backend = backend
+        self.digest = None
+        self.size = 0
+
+    def load(self, passphrase=None):
+        """Returns the list of the changes of the journal (empty if it
+        doesn't exist or is the journal of a previous database file).
+        An incomplete last frame (interrupted append) is ignored and
+        will be overwritten. Raises a CodingError if a frame can't be
+        decoded."""
+        self.digest = symbols.file_digest(self.filename)
+        self.size = 0
+        if not os.path.exists(self.journal_filename):
+            return []
+        with open(self.journal_filename, 'rb') as f:
+            data = f.read()
+        header = data[:JOURNAL_HEADER.size]
+        if len(header) != JOURNAL_HEADER.size or \
+           JOURNAL_HEADER.unpack(header) != (JOURNAL_MAGIC, self.digest):
+            return []
+        changes = []
+        offset = JOURNAL_HEADER.size
+        while len(data) - offset >= FRAME_SIZE.size:
+            size, = FRAME_SIZE.unpack_from(data, offset)
+            start = offset + FRAME_SIZE.size
+            if len(data) < start + size:
+                break
+            frame = data[start:start + size]
+            if self.backend:
+                frame = self.backend.decrypt(frame, passphrase, JOURNAL_MAGIC)
+            changes.extend(decode_changes(frame))
+            offset = start + size
+        self.size = offset
+        return changes
+
+    def append(self, changes, passphrase=None):
+        """Appends a frame with a list of changes to the journal. The
+        frame is synced to the disk."""
+        if self.digest is None:
+            raise ValueError("The journal has not been loaded")
+        frame = encode_changes(changes)
+        if self.backend:
+            frame = self.backend.encrypt(frame, passphrase)
+        # Like the database, the journal is only readable by the user
+        fd = os.open(self.journal_filename,
+                     os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0600)
+        with os.fdopen(fd, 'ab') as f:
+            f.truncate(self.size)
+            if self.size == 0:
+                f.write(JOURNAL_HEADER.pack(JOURNAL_MAGIC, self.digest))
+            f.write(FRAME_SIZE.pack(len(frame)) + frame)
+            f.flush()
+            os.fsync(f.fileno())
+            self.size = f.tell()
+
+    def reset(self):
+        """Removes the journal once the database file has been
+        saved."""
+        if os.path.exists(self.journal_filename):
+            os.remove(self.journal_filename)
+        self.digest = symbols.file_digest(self.filename)
+        self.size = 0
+
+def open_temporary(tmp_filename, filename):
+    """Creates a temporary file (opened for writing) which will replace
+    a file once written. It gets the mode of the file if it exists and
+    is only readable by the user otherwise."""
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+    f = os.fdopen(os.open(tmp_filename, flags, 0600), 'wb')
+    if os.path.exists(filename):
+        shutil.copymode(filename, tmp_filename)
+    return f
+
 class Loader:
     """A Loader is used to save and load password entries from a
     file. Loader is an abstract class that should be overriden."""
+    # Fields of the entries passed to the select function of
+    # load_selection (None if all the entries are loaded).
+    index_fields = None
 
     def save(self, entries, filename, passphrase=None):
         """Saves a list of password entries in a file using an optional
@@ -56,54 +627,503 @@ class Loader:
         be overriden."""
         pass
 
+    def load_selection(self, filename, passphrase, select):
+        """Loads and returns a list of password entries from a file
+        that contains at least the entries returned by select (in the
+        same order). select is a function taking and returning a list
+        of objects having the index_fields attributes of the entries.
+        By default all the entries are loaded."""
+        return self.load(filename, passphrase)
+
+    def open_journal(self, filename):
+        """Returns the Journal of a file or None if the loader doesn't
+        support journals."""
+        return None
+
 class YAMLLoader(Loader):
     """A YAMLLoader stores and retrieves password entries using YAML
-    in a plain text file."""
+    in a plain text file. Its journal is not encrypted."""
+
+    def open_journal(self, filename):
+        return Journal(filename)
 
     def save(self, entries, filename, passphrase=None):
         with open(filename, 'w') as f:
-            yaml.dump(entries, f)
+            yaml_dump(entries, f)
 
     def load(self, filename, passphrase=None):
         with open(filename) as f:
             return yaml_load(f)
 
+class OpenSSLReader:
+    """An OpenSSLReader is a file-like object decrypting a stream with
+    an openssl aes-256-cbc process. The passphrase is passed to
+    OpenSSL in its environment rather than on its command line."""
+
+    def __init__(self, stream, passphrase):
+        self.errors = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(OPENSSL_CMD + ["-d"], stdin=stream,
+                                        stdout=subprocess.PIPE,
+                                        stderr=self.errors,
+                                        env=openssl_env(passphrase))
+
+    def read(self, size=-1):
+        return self.process.stdout.read(size)
+
+    def close(self):
+        """Waits for OpenSSL. Raises a CodingError if it failed."""
+        self.process.stdout.close()
+        returncode = self.process.wait()
+        self.errors.close()
+        if returncode:
+            raise CodingError
+
+class OpenSSLWriter:
+    """An OpenSSLWriter is a file-like object encrypting the data
+    written in it to a stream with an openssl aes-256-cbc process."""
+
+    def __init__(self, stream, passphrase):
+        self.errors = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(OPENSSL_CMD, stdin=subprocess.PIPE,
+                                        stdout=stream, stderr=self.errors,
+                                        env=openssl_env(passphrase))
+
+    def write(self, data):
+        self.process.stdin.write(data)
+
+    def close(self):
+        """Waits for OpenSSL. Raises a CodingError if it failed."""
+        self.process.stdin.close()
+        returncode = self.process.wait()
+        self.errors.close()
+        if returncode:
+            raise CodingError
+
+class AESReader:
+    """An AESReader is a file-like object decrypting by blocks a
+    stream encrypted with AES-256-CBC in OpenSSL's format (see
+    AESBackend) with an InProcessBackend's cipher."""
+
+    def __init__(self, stream, passphrase, new_cipher, magic=None,
+                 block=65536):
+        """Reads the salt and derives the key. Both digests used by
+        OpenSSL are tried if the plaintext must start with magic.
+        Raises a CodingError if the header is invalid or if the magic
+        string isn't found."""
+        self.stream = stream
+        self.block = block
+        header = stream.read(len(SALT_MAGIC) + 8)
+        if len(header) != len(SALT_MAGIC) + 8 or \
+           not header.startswith(SALT_MAGIC):
+            raise CodingError
+        salt = header[len(SALT_MAGIC):]
+        first = stream.read(16)
+        for digest in DIGESTS:
+            key, iv = evp_bytes_to_key(passphrase, salt, digest)
+            self.decrypt = new_cipher(key, iv, True)
+            self.buffer = self.decrypt(first) if len(first) == 16 else ""
+            if not magic or self.buffer.startswith(magic):
+                break
+        else:
+            raise CodingError
+        self.pending = first[16:] if len(first) == 16 else first
+        self.eof = False
+
+    def read(self, size=-1):
+        """Returns at most size decrypted bytes (all the remaining ones
+        if size is negative). The last block is only returned once the
+        padding has been checked. Raises a CodingError if the padding
+        is invalid."""
+        while not self.eof and (size < 0 or len(self.buffer) - 16 < size):
+            data = self.stream.read(self.block)
+            if data:
+                data = self.pending + data
+                n = len(data) - len(data) % 16
+                self.buffer += self.decrypt(data[:n])
+                self.pending = data[n:]
+            else:
+                self.eof = True
+                if self.pending or not self.buffer:
+                    raise CodingError
+                padding = ord(self.buffer[-1])
+                if not 1 <= padding <= 16 or \
+                   self.buffer[-padding:] != chr(padding) * padding:
+                    raise CodingError
+                self.buffer = self.buffer[:-padding]
+        available = len(self.buffer) if self.eof else len(self.buffer) - 16
+        if size < 0 or size > available:
+            size = max(available, 0)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        pass
+
+class AESWriter:
+    """An AESWriter is a file-like object encrypting the data written
+    in it to a stream with AES-256-CBC in OpenSSL's format (see
+    AESBackend) with an InProcessBackend's cipher. It must be closed
+    to write the last block."""
+
+    def __init__(self, stream, passphrase, new_cipher):
+        salt = os.urandom(8)
+        key, iv = evp_bytes_to_key(passphrase, salt, DIGESTS[0])
+        self.encrypt = new_cipher(key, iv, False)
+        self.stream = stream
+        self.stream.write(SALT_MAGIC + salt)
+        self.pending = ""
+
+    def write(self, data):
+        data = self.pending + data
+        n = len(data) - len(data) % 16
+        if n:
+            self.stream.write(self.encrypt(data[:n]))
+        self.pending = data[n:]
+
+    def close(self):
+        """Pads and writes the last block."""
+        padding = 16 - len(self.pending)
+        self.stream.write(self.encrypt(self.pending + chr(padding) * padding))
+
+class AESBackend:
+    """An AESBackend encrypts and decrypts streams using the format of
+    openssl aes-256-cbc with a salt: the "Salted__" string, an 8 bytes
+    salt and the ciphertext (with a PKCS#7 padding). The key and the
+    IV are derived from the passphrase and the salt with
+    EVP_BytesToKey using SHA-256 (OpenSSL >= 1.1.0) or MD5 (older
+    versions, only when decrypting). AESBackend is an abstract
+    class."""
+    name = None
+
+    def open_reader(self, stream, passphrase, magic=None):
+        """Returns a file-like object decrypting a stream. magic is an
+        optional string the plaintext starts with. Its close method
+        raises a CodingError if the decryption failed."""
+        raise NotImplementedError
+
+    def open_writer(self, stream, passphrase):
+        """Returns a file-like object encrypting the data written in
+        it to a stream. It must be closed."""
+        raise NotImplementedError
+
+    def encrypt(self, data, passphrase):
+        """Returns the encryption of a string."""
+        with tempfile.TemporaryFile() as f:
+            writer = self.open_writer(f, passphrase)
+            try:
+                writer.write(data)
+            finally:
+                writer.close()
+            f.seek(0)
+            return f.read()
+
+    def decrypt(self, data, passphrase, magic=None):
+        """Returns the decryption of a string (see open_reader). Raises
+        a CodingError if the decryption failed."""
+        with tempfile.TemporaryFile() as f:
+            f.write(data)
+            f.seek(0)
+            reader = self.open_reader(f, passphrase, magic)
+            try:
+                return reader.read()
+            finally:
+                reader.close()
+
+class OpenSSLBackend(AESBackend):
+    """An OpenSSLBackend encrypts and decrypts streams with openssl
+    aes-256-cbc processes."""
+    name = "openssl"
+
+    def open_reader(self, stream, passphrase, magic=None):
+        return OpenSSLReader(stream, passphrase)
+
+    def open_writer(self, stream, passphrase):
+        return OpenSSLWriter(stream, passphrase)
+
+class InProcessBackend(AESBackend):
+    """An InProcessBackend encrypts and decrypts streams in-process
+    with a crypto library. This class is abstract, new_cipher must be
+    overriden."""
+
+    def new_cipher(self, key, iv, decrypt):
+        """Returns a function encrypting (or decrypting) data whose
+        length is a multiple of the block size, keeping the CBC state
+        between calls."""
+        raise NotImplementedError
+
+    def open_reader(self, stream, passphrase, magic=None):
+        return AESReader(stream, passphrase, self.new_cipher, magic)
+
+    def open_writer(self, stream, passphrase):
+        return AESWriter(stream, passphrase, self.new_cipher)
+
+    def encrypt(self, data, passphrase):
+        stream = StringIO.StringIO()
+        writer = self.open_writer(stream, passphrase)
+        writer.write(data)
+        writer.close()
+        return stream.getvalue()
+
+    def decrypt(self, data, passphrase, magic=None):
+        return self.open_reader(StringIO.StringIO(data), passphrase,
+                                magic).read()
+
+class CryptographyBackend(InProcessBackend):
+    """A CryptographyBackend uses the cryptography library."""
+    name = "cryptography"
+
+    def new_cipher(self, key, iv, decrypt):
+        cipher = Cipher(algorithms.AES(key), modes.CBC(iv),
+                        backend=default_backend())
+        return (cipher.decryptor() if decrypt else cipher.encryptor()).update
+
+class PyCryptoBackend(InProcessBackend):
+    """A PyCryptoBackend uses PyCrypto (or PyCryptodome)."""
+    name = "pycrypto"
+
+    def new_cipher(self, key, iv, decrypt):
+        cipher = AES.new(key, AES.MODE_CBC, iv)
+        return cipher.decrypt if decrypt else cipher.encrypt
+
+def get_aes_backends():
+    """Returns the list of the available AES backends, the in-process
+    ones first."""
+    backends = []
+    if Cipher is not None:
+        backends.append(CryptographyBackend())
+    if AES is not None:
+        backends.append(PyCryptoBackend())
+    backends.append(OpenSSLBackend())
+    return backends
+
+def get_aes_backend(name=None):
+    """Returns the AES backend with the given name or the first
+    available one. Raises a ValueError if the backend is unknown or
+    unavailable."""
+    for backend in get_aes_backends():
+        if name is None or backend.name == name:
+            return backend
+    raise ValueError("Unknown or unavailable AES backend: {}".format(name))
+
 class AESLoader(Loader):
-    """An AESLoader stores and retrieves password entries using YAML,
-    bzip2 and AES-256-CBC (with OpenSSL) using a passphrase."""
+    """An AESLoader stores and retrieves password entries using a
+    serializer (YAML by default), bzip2 and AES-256-CBC (OpenSSL's
+    format) using a passphrase. The encryption is done by an AES
+    backend (see get_aes_backend). The three stages are chained as a
+    stream: the whole plaintext is never kept in memory. The
+    serializer of a loaded file is detected (see load_entries)."""
+
+    def __init__(self, backend=None, serializer=None):
+        self.backend = backend or get_aes_backend()
+        self.serializer = serializer or get_serializer()
+
+    def open_journal(self, filename):
+        return Journal(filename, self.backend)
 
     def save(self, entries, filename, passphrase=None):
-        """Saves the entries from the filename using OpenSSL, bzip2
-        and YAML. Raises a CodingError if OpenSSL was unable to encode
-        the file."""
-        with open(filename, 'w') as f:
-            cmd = "openssl aes-256-cbc -salt -pass pass:{}".format(passphrase)
-            p = subprocess.Popen(shlex.split(cmd),
-                                 stdin=subprocess.PIPE,
-                                 stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE)
-            result = p.communicate(bz2.compress(yaml.dump(entries)))
-            if not result[1]:
-                f.write(result[0])
-            else:
-                raise CodingError
+        """Saves the entries from the filename using the serializer,
+        bzip2 and the AES backend. The dump is compressed and
+        encrypted on the fly to a temporary file replacing the file once done.
+        Raises a CodingError if the backend was unable to encode the
+        file."""
+        tmp_filename = "{}.{}.tmp".format(filename, os.getpid())
+        try:
+            with open_temporary(tmp_filename, filename) as f:
+                writer = self.backend.open_writer(f, passphrase)
+                try:
+                    compressor = BZ2Writer(writer)
+                    self.serializer.dump(entries, compressor)
+                    compressor.close()
+                finally:
+                    writer.close()
+            os.rename(tmp_filename, filename)
+        finally:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
 
     def load(self, filename, passphrase=None):
-        """Loads the entries from the filename using OpenSSL and
-        YAML. Raises a CodingError if OpenSSL was unable to decode the
+        """Loads the entries from the filename using the AES backend,
+        bzip2 and the detected serializer. The file is decrypted, decompressed and parsed
+        on the fly. Raises a CodingError if the backend was unable to
+        decode the file."""
+        with open(filename, 'rb') as f:
+            reader = self.backend.open_reader(f, passphrase, BZ2_MAGIC)
+            try:
+                entries = load_entries(BZ2Reader(reader))
+            except (IOError, EOFError, yaml.YAMLError, CodingError):
+                # Garbage produced with a wrong passphrase.
+                entries = None
+            finally:
+                reader.close()
+        if entries is None:
+            raise CodingError
+        return entries
+
+# Chunked format (see ChunkedLoader): a header (magic string, offset
+# and size of the index) followed by the blocks and the index. A block
+# is the records of its entries compressed with bzip2 and encrypted.
+# The index (compressed with bzip2 and encrypted) is the magic string,
+# the number of blocks, the offset, size and number of entries of each
+# block, the names and the usernames of the entries (see
+# encode_strings, in the same order as the blocks), the number of
+# distinct sets of tags, each set (its number of tags and the tags)
+# and the array of the set of tags of each entry.
+CHUNKED_MAGIC = "PMCHK001"
+CHUNKED_HEADER = struct.Struct("<8sQI")
+BLOCK = struct.Struct("<QII")
+
+class IndexEntry(object):
+    """An IndexEntry holds the fields of an entry stored in the index
+    of a ChunkedLoader's file."""
+    __slots__ = ["name", "username", "tags"]
+
+    def __init__(self, name, username, tags):
+        self.name = name
+        self.username = username
+        self.tags = tags
+
+class ChunkedLoader(Loader):
+    """A ChunkedLoader stores password entries in independently
+    compressed and encrypted blocks (using an AES backend) with an
+    encrypted index of the names, usernames and tags of the entries,
+    so that only the index and the blocks of the selected entries
+    are decrypted by load_selection."""
+    index_fields = frozenset(["name", "username", "tags"])
+
+    def __init__(self, backend=None, block_size=1000):
+        """Initializes the loader with the number of entries of each
+        block."""
+        self.backend = backend or get_aes_backend()
+        self.block_size = block_size
+
+    def encode_block(self, entries, passphrase):
+        """Returns the encrypted block of a list of entries."""
+        stream = StringIO.StringIO()
+        compressor = BZ2Writer(stream)
+        records_dump(entries, compressor)
+        compressor.close()
+        return self.backend.encrypt(stream.getvalue(), passphrase)
+
+    def save(self, entries, filename, passphrase=None):
+        """Saves the entries in blocks to a temporary file replacing
+        the file once done. The index is written after the blocks.
+        Raises a CodingError if the backend was unable to encode the
         file."""
-        with open(filename) as f:
-            cmd = "openssl aes-256-cbc -d -salt " + \
-                  "-pass pass:{}".format(passphrase)
-            p = subprocess.Popen(shlex.split(cmd),
-                                 stdin=subprocess.PIPE,
-                                 stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE)
-            result = p.communicate(f.read())
-            if not result[1]:
-                return yaml_load(bz2.decompress(result[0]))
-            else:
-                raise CodingError
+        tmp_filename = "{}.{}.tmp".format(filename, os.getpid())
+        try:
+            with open_temporary(tmp_filename, filename) as f:
+                f.write(CHUNKED_HEADER.pack(CHUNKED_MAGIC, 0, 0))
+                index = [CHUNKED_MAGIC, POSITION.pack(0)]
+                for i in xrange(0, len(entries), self.block_size):
+                    block = entries[i:i + self.block_size]
+                    data = self.encode_block(block, passphrase)
+                    index.append(BLOCK.pack(f.tell(), len(data), len(block)))
+                    f.write(data)
+                index[1] = POSITION.pack(len(index) - 2)
+                index.append(encode_strings([e.name for e in entries]))
+                index.append(encode_strings([e.username for e in entries]))
+                tag_sets = {}
+                for e in entries:
+                    tag_sets.setdefault(e.tags, len(tag_sets))
+                index.append(POSITION.pack(len(tag_sets)))
+                for tags, i in sorted(tag_sets.items(), key=lambda t: t[1]):
+                    index.append(STRING_SIZE.pack(len(tags)))
+                    index.append(encode_strings(sorted(tags)))
+                index.append(struct.pack("<{}I".format(len(entries)),
+                                         *[tag_sets[e.tags] for e in entries]))
+                data = self.backend.encrypt(bz2.compress("".join(index)),
+                                            passphrase)
+                offset = f.tell()
+                f.write(data)
+                f.seek(0)
+                f.write(CHUNKED_HEADER.pack(CHUNKED_MAGIC, offset, len(data)))
+            os.rename(tmp_filename, filename)
+        finally:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+
+    def load_index(self, f, passphrase):
+        """Returns the list of the blocks (offset, size and number of
+        entries) and the list of the IndexEntries of an opened file. Raises a
+        CodingError if the index can't be decoded."""
+        header = f.read(CHUNKED_HEADER.size)
+        if len(header) != CHUNKED_HEADER.size:
+            raise CodingError("Truncated chunked header")
+        magic, offset, size = CHUNKED_HEADER.unpack(header)
+        if magic != CHUNKED_MAGIC:
+            raise CodingError("Not a chunked file")
+        f.seek(offset)
+        data = self.backend.decrypt(f.read(size), passphrase, BZ2_MAGIC)
+        try:
+            data = bz2.decompress(data)
+        except (IOError, EOFError):
+            raise CodingError("Invalid chunked index")
+        if not data.startswith(CHUNKED_MAGIC):
+            raise CodingError("Invalid chunked index")
+        try:
+            offset = len(CHUNKED_MAGIC)
+            n, = POSITION.unpack_from(data, offset)
+            offset += POSITION.size
+            blocks = []
+            for i in xrange(n):
+                blocks.append(BLOCK.unpack_from(data, offset))
+                offset += BLOCK.size
+            n = sum(b[2] for b in blocks)
+            names, offset = decode_strings(data, offset, n)
+            usernames, offset = decode_strings(data, offset, n)
+            tag_sets = []
+            count, = POSITION.unpack_from(data, offset)
+            offset += POSITION.size
+            for i in xrange(count):
+                size, = STRING_SIZE.unpack_from(data, offset)
+                tags, offset = decode_strings(data, offset + STRING_SIZE.size,
+                                              size)
+                tag_sets.append(passman.intern_tags(tags))
+            ids = struct.unpack_from("<{}I".format(n), data, offset)
+            entries = [IndexEntry(name, username, tag_sets[i])
+                       for name, username, i in zip(names, usernames, ids)]
+        except (struct.error, IndexError):
+            raise CodingError("Invalid chunked index")
+        return blocks, entries
+
+    def load_block(self, f, block, passphrase):
+        """Returns the entries of a block of an opened file. Raises a
+        CodingError if the block can't be decoded."""
+        offset, size, count = block
+        f.seek(offset)
+        data = self.backend.decrypt(f.read(size), passphrase, BZ2_MAGIC)
+        try:
+            entries = records_load(StringIO.StringIO(bz2.decompress(data)))
+        except (IOError, EOFError):
+            raise CodingError("Invalid block")
+        if len(entries) != count:
+            raise CodingError("Invalid block")
+        return entries
+
+    def load(self, filename, passphrase=None):
+        """Loads the entries of all the blocks. Raises a CodingError if
+        the backend was unable to decode the file."""
+        return self.load_selection(filename, passphrase, lambda e: e)
+
+    def load_selection(self, filename, passphrase, select):
+        """Loads the entries of the blocks holding the entries of the
+        index returned by select. Raises a CodingError if the backend
+        was unable to decode the file."""
+        with open(filename, 'rb') as f:
+            blocks, index = self.load_index(f, passphrase)
+            positions = dict((id(e), i) for i, e in enumerate(index))
+            selected = set(positions[id(e)] for e in select(index))
+            entries = []
+            start = 0
+            for block in blocks:
+                end = start + block[2]
+                if any(i in selected for i in xrange(start, end)):
+                    entries.extend(self.load_block(f, block, passphrase))
+                start = end
+        return entries
+
+    def open_journal(self, filename):
+        return Journal(filename, self.backend)
 
 class GPGLoader(Loader):
     """A GPGLoader stores and retrieves password entries using YAML,
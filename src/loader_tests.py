@@ -16,34 +16,288 @@
 # along with PassMAN.  If not, see <http://www.gnu.org/licenses/>.
 
 import unittest
+import os
+import bz2
+import hashlib
+import subprocess
+import tempfile
+import StringIO
+import yaml
 
-from loader import YAMLLoader, AESLoader, GPGLoader
+import loader
 
-class TestYAMLLoader(unittest.TestCase):
+from loader import YAMLLoader, AESLoader, GPGLoader, CodingError
+from loader import yaml_load, yaml_dump, BZ2Reader, BZ2Writer
+from loader import records_load, records_dump, load_entries
+from passman import PasswordEntry
+
+def get_entries(n):
+    return [PasswordEntry("sha512:ascii", "name{}".format(i),
+                          u"user\xe9{}".format(i), tags=["tag{}".format(i % 3)])
+            for i in xrange(n)]
+
+class TestYAMLStreams(unittest.TestCase):
+    def test_dump(self):
+        entries = get_entries(10)
+        stream = StringIO.StringIO()
+        yaml_dump(entries, stream)
+        self.assertEqual(stream.getvalue(), yaml.dump(entries))
+        stream = StringIO.StringIO()
+        yaml_dump([], stream)
+        self.assertEqual(stream.getvalue(), yaml.dump([]))
+
+    def test_load(self):
+        entries = get_entries(10)
+        self.assertEqual(yaml_load(yaml.dump(entries)), entries)
+        self.assertEqual(yaml_load(StringIO.StringIO(yaml.dump(entries))),
+                         entries)
+        self.assertEqual(yaml_load("[]"), [])
+        self.assertEqual(yaml_load(""), None)
+        self.assertEqual(yaml_load("{a: 1}"), {"a": 1})
+
+    def test_bz2(self):
+        data = yaml.dump(get_entries(1000))
+        stream = StringIO.StringIO()
+        writer = BZ2Writer(stream)
+        writer.write(data[:100])
+        writer.write(data[100:])
+        writer.close()
+        self.assertEqual(bz2.decompress(stream.getvalue()), data)
+        reader = BZ2Reader(StringIO.StringIO(stream.getvalue()), 1024)
+        self.assertEqual(reader.read(10), data[:10])
+        self.assertEqual(reader.read(), data[10:])
+        self.assertEqual(reader.read(10), "")
+        reader = BZ2Reader(StringIO.StringIO(stream.getvalue()[:-10]))
+        self.assertRaises(IOError, reader.read)
+
+class TestRecords(unittest.TestCase):
     def setUp(self):
-        pass
+        self.filename = "test_records.db"
 
     def tearDown(self):
-        pass
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
 
-    def test_save(self):
-        self.assertEqual(True, False)
+    def dump(self, entries):
+        stream = StringIO.StringIO()
+        records_dump(entries, stream)
+        return stream.getvalue()
 
-    def test_load(self):
-        self.assertTrue(False)
+    def test_dump_load(self):
+        entries = get_entries(1000)
+        entries[0].entropy = 64.5
+        entries[1].fingerprint = "abcd"
+        entries[2].comment = u"comment\xe9"
+        data = self.dump(entries)
+        self.assertTrue(data.startswith(loader.RECORDS_MAGIC))
+        loaded = records_load(StringIO.StringIO(data), 100)
+        self.assertEqual(loaded, entries)
+        for e, l in zip(entries, loaded):
+            self.assertEqual(l.__getstate__(), e.__getstate__())
+        self.assertEqual(type(loaded[0].name), str)
+        self.assertEqual(type(loaded[0].username), unicode)
+        self.assertEqual(records_load(StringIO.StringIO(self.dump([]))), [])
+
+    def test_invalid(self):
+        data = self.dump(get_entries(10))
+        for invalid in [data[:-1], data[:5], "PMREC999" + data[8:]]:
+            self.assertRaises(CodingError, records_load,
+                              StringIO.StringIO(invalid))
+
+    def test_load_entries(self):
+        entries = get_entries(10)
+        self.assertEqual(load_entries(StringIO.StringIO(self.dump(entries))),
+                         entries)
+        self.assertEqual(load_entries(StringIO.StringIO(yaml.dump(entries))),
+                         entries)
+
+    def test_get_serializer(self):
+        self.assertEqual(loader.get_serializer().name, "yaml")
+        self.assertEqual(loader.get_serializer("records").name, "records")
+        self.assertRaises(ValueError, loader.get_serializer, "unknown")
+
+    def test_aes(self):
+        entries = get_entries(100)
+        records = AESLoader(serializer=loader.get_serializer("records"))
+        records.save(entries, self.filename, "passphrase")
+        self.assertEqual(AESLoader().load(self.filename, "passphrase"),
+                         entries)
+        AESLoader().save(entries, self.filename, "passphrase")
+        self.assertEqual(records.load(self.filename, "passphrase"), entries)
 
-class TestAESLoader(unittest.TestCase):
+class TestJournal(unittest.TestCase):
     def setUp(self):
-        pass
+        self.filename = "test_journal.db"
+        with open(self.filename, 'w') as f:
+            f.write("database")
+        self.entries = get_entries(3)
+        self.changes = [("set", self.entries[0]), ("remove", [0, 2]),
+                        ("tags", 1, [u"tag\xe9", "tag"]),
+                        ("fingerprint", 2, "abcd")]
 
     def tearDown(self):
-        pass
+        for f in [self.filename, self.filename + ".journal"]:
+            if os.path.exists(f):
+                os.remove(f)
 
-    def test_save(self):
-        self.assertEqual(True, False)
+    def test_encode_changes(self):
+        changes = loader.decode_changes(loader.encode_changes(self.changes))
+        self.assertEqual(changes[0], ("set", self.entries[0]))
+        self.assertEqual(changes[1], ("remove", [0, 2]))
+        self.assertEqual(changes[2], ("tags", 1, ["tag", u"tag\xe9"]))
+        self.assertEqual(changes[3], ("fingerprint", 2, "abcd"))
+        data = loader.encode_changes(self.changes)
+        for invalid in [data[:-1], data[8:], data + "X"]:
+            self.assertRaises(CodingError, loader.decode_changes, invalid)
 
-    def test_load(self):
-        self.assertTrue(False)
+    def test_append_load(self):
+        for backend in [None] + loader.get_aes_backends():
+            journal = loader.Journal(self.filename, backend)
+            self.assertEqual(journal.load("passphrase"), [])
+            journal.append(self.changes[:1], "passphrase")
+            journal.append(self.changes[1:], "passphrase")
+            self.assertEqual(os.stat(journal.journal_filename).st_mode
+                             & 0777, 0600)
+            journal = loader.Journal(self.filename, backend)
+            self.assertEqual(len(journal.load("passphrase")), 4)
+            if backend:
+                self.assertRaises(CodingError, journal.load, "wrong")
+            journal.reset()
+            self.assertEqual(journal.load("passphrase"), [])
+
+    def test_interrupted_append(self):
+        journal = loader.Journal(self.filename)
+        journal.load()
+        journal.append(self.changes[:1])
+        size = journal.size
+        journal.append(self.changes[1:])
+        with open(journal.journal_filename, 'r+b') as f:
+            f.truncate(journal.size - 1)
+        self.assertEqual(len(journal.load()), 1)
+        self.assertEqual(journal.size, size)
+        journal.append(self.changes[1:2])
+        self.assertEqual(len(loader.Journal(self.filename).load()), 2)
+
+    def test_stale(self):
+        journal = loader.Journal(self.filename)
+        journal.load()
+        journal.append(self.changes)
+        with open(self.filename, 'w') as f:
+            f.write("saved again")
+        self.assertEqual(journal.load(), [])
+        journal.append(self.changes[:1])
+        self.assertEqual(len(loader.Journal(self.filename).load()), 1)
+
+class TestChunkedLoader(unittest.TestCase):
+    def setUp(self):
+        self.filename = "test_chunked.db"
+        self.entries = get_entries(95)
+
+    def tearDown(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def test_save_load(self):
+        for backend in loader.get_aes_backends():
+            chunked = loader.ChunkedLoader(backend, 10)
+            chunked.save(self.entries, self.filename, "passphrase")
+            self.assertEqual(chunked.load(self.filename, "passphrase"),
+                             self.entries)
+            self.assertRaises(CodingError, chunked.load, self.filename,
+                              "wrong")
+        chunked.save([], self.filename, "passphrase")
+        self.assertEqual(chunked.load(self.filename, "passphrase"), [])
+        self.assertFalse([f for f in os.listdir(".") if f.endswith(".tmp")])
+
+    def test_load_selection(self):
+        chunked = loader.ChunkedLoader(block_size=10)
+        chunked.save(self.entries, self.filename, "passphrase")
+        def select(entries):
+            self.assertEqual([e.name for e in entries],
+                             [e.name for e in self.entries])
+            self.assertEqual(entries[4].tags, self.entries[4].tags)
+            return [entries[5], entries[42], entries[48]]
+        entries = chunked.load_selection(self.filename, "passphrase", select)
+        self.assertEqual(entries, self.entries[:10] + self.entries[40:50])
+        self.assertEqual(chunked.load_selection(self.filename, "passphrase",
+                                                lambda e: []), [])
+
+    def test_file_mode(self):
+        for save in [loader.ChunkedLoader().save, loader.AESLoader().save]:
+            save(self.entries, self.filename, "passphrase")
+            self.assertEqual(os.stat(self.filename).st_mode & 0777, 0600)
+            os.chmod(self.filename, 0640)
+            save(self.entries, self.filename, "passphrase")
+            self.assertEqual(os.stat(self.filename).st_mode & 0777, 0640)
+            os.remove(self.filename)
+
+    def test_invalid(self):
+        self.assertRaises(CodingError, loader.ChunkedLoader().load,
+                          __file__, "passphrase")
+
+class TestAESBackends(unittest.TestCase):
+    def setUp(self):
+        self.filename = "test_aes.db"
+        self.backends = loader.get_aes_backends()
+
+    def tearDown(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def openssl(self, args, data):
+        cmd = ["openssl", "aes-256-cbc", "-pass", "pass:passphrase"] + args
+        p = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return p.communicate(data)[0]
+
+    def test_evp_bytes_to_key(self):
+        salt = "0102030405060708".decode("hex")
+        key, iv = loader.evp_bytes_to_key("passphrase", salt, hashlib.sha256)
+        self.assertEqual(key.encode("hex"), "8619588b57a78727285bcf125b4f70fd"
+                         "399774df620e02a4c754fdff5a99e473")
+        self.assertEqual(iv.encode("hex"), "cf5a4d907e3397bc9aec8f4bbda70508")
+        key, iv = loader.evp_bytes_to_key("passphrase", salt, hashlib.md5)
+        self.assertEqual(key.encode("hex"), "1e484203cc6c24a583c6d045d97877c6"
+                         "0e3081317b231be171d4b9b9892eb6c0")
+        self.assertEqual(iv.encode("hex"), "d9d97c2fb05c9668ae93a151a26dacbe")
+
+    def test_get_backend(self):
+        self.assertEqual(loader.get_aes_backend("openssl").name, "openssl")
+        self.assertEqual(loader.get_aes_backend().name,
+                         self.backends[0].name)
+        self.assertRaises(ValueError, loader.get_aes_backend, "unknown")
+
+    def test_save_load(self):
+        entries = get_entries(100)
+        for backend in self.backends:
+            aes = AESLoader(backend)
+            aes.save(entries, self.filename, "passphrase")
+            for other in self.backends:
+                self.assertEqual(AESLoader(other).load(self.filename,
+                                                       "passphrase"),
+                                 entries)
+            self.assertRaises(CodingError, aes.load, self.filename, "wrong")
+        self.assertFalse([f for f in os.listdir(".") if f.endswith(".tmp")])
+
+    def test_openssl_format(self):
+        data = bz2.compress(yaml.dump(get_entries(10)))
+        for backend in self.backends:
+            with tempfile.TemporaryFile() as f:
+                writer = backend.open_writer(f, "passphrase")
+                writer.write(data)
+                writer.close()
+                f.seek(0)
+                self.assertEqual(self.openssl(["-d", "-md", "sha256"],
+                                              f.read()), data)
+            digests = ["sha256", "md5"] if backend.name != "openssl" \
+                      else ["sha256"]
+            for digest in digests:
+                with tempfile.TemporaryFile() as f:
+                    f.write(self.openssl(["-md", digest], data))
+                    f.seek(0)
+                    reader = backend.open_reader(f, "passphrase", "BZh")
+                    self.assertEqual(reader.read(), data)
+                    reader.close()
 
 class TestGPGLoader(unittest.TestCase):
     def setUp(self):
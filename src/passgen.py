@@ -18,9 +18,62 @@
 import random
 import hashlib
 import math
+import struct
 import base64
 import os.path
 import re
+import binascii
+import threading
+import time
+import collections
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import symbols
+
+class BufferedSystemRandom(random.SystemRandom):
+    """A BufferedSystemRandom is a SystemRandom reading the random
+    bytes from os.urandom by blocks instead of calling os.urandom for
+    each random number. It must not be shared between threads."""
+
+    def __init__(self, size=4096):
+        """Initializes the generator with empty buffers which will be
+        filled with size bytes at once."""
+        self.size = size
+        self.buf = ""
+        self.pos = 0
+        self.floats = []
+        random.SystemRandom.__init__(self)
+
+    def read(self, n):
+        """Returns n random bytes from the buffer."""
+        if self.pos + n > len(self.buf):
+            self.buf = self.buf[self.pos:] + os.urandom(max(self.size, n))
+            self.pos = 0
+        data = self.buf[self.pos:self.pos + n]
+        self.pos += n
+        return data
+
+    def random(self):
+        """Returns the next random float in the range [0.0, 1.0). The
+        floats are computed for a whole buffer at once (using 53 bits
+        out of each 8 bytes read from the buffer)."""
+        if not self.floats:
+            count = max(self.size // 8, 1)
+            values = struct.unpack(">{}Q".format(count), self.read(8 * count))
+            self.floats = [(x >> 11) * random.RECIP_BPF for x in values]
+        return self.floats.pop()
+
+    def getrandbits(self, k):
+        """Returns a long with k random bits."""
+        if k <= 0:
+            raise ValueError("number of bits must be greater than zero")
+        size = (k + 7) // 8
+        x = long(binascii.hexlify(self.read(size)), 16)
+        return x >> (size * 8 - k)
 
 class PasswordGenerator:
     """A PasswordGenerator is an object used to generate a pseudo-random
@@ -32,6 +85,11 @@ class PasswordGenerator:
     class is abstract and subclasses implement different algorithms."""
     yaml_tag = u'!PasswordGenerator'
 
+    def __init__(self):
+        """Initializes the generator's fingerprint which identifies
+        the algorithm."""
+        self.fingerprint = hashlib.sha1(self.yaml_tag).hexdigest()
+
     def get_entropy(self, length):
         """Returns the entropy for a given length. This is an abstract
         method that needs to be overriden."""
@@ -46,10 +104,11 @@ class PasswordGenerator:
         is an abstract method that needs to be overriden."""
         pass
 
-    def get_next_password(self, n=15):
+    def get_next_password(self, n=15, rng=random):
         """Returns the next password given of length n (15 by default) by
-        the generator. This is an abstract method that needs to be
-        overriden."""
+        the generator using the pseudo-random generator rng (the
+        global random module by default). This is an abstract method
+        that needs to be overriden."""
         pass
 
     def get_random_password(self, n=15):
@@ -57,13 +116,26 @@ class PasswordGenerator:
         method is cryptographically secure as the random seed used for
         password generation is obtained with os.urandom function to
         get entropy from the system and generates 1024 bits sequence
-        used as seed."""
-        state = random.getstate()
-        seed = os.urandom(1024)
-        random.seed(seed)
-        password = self.get_next_password(n)
-        random.setstate(state)
-        return password
+        used as seed. A private random.Random instance is used so the
+        global random state is never modified."""
+        rng = random.Random(os.urandom(1024))
+        return self.get_next_password(n, rng)
+
+    def get_random_passwords(self, count, n=15):
+        """Yields count random passwords of length n (15 by default).
+        The random numbers are obtained from a BufferedSystemRandom so
+        os.urandom is called for large blocks of bytes instead of for
+        each password."""
+        rng = BufferedSystemRandom()
+        for i in xrange(count):
+            yield self.get_next_password(n, rng)
+
+    def get_vectorized_random_passwords(self, count, n=15):
+        """Yields count random passwords of length n (15 by default)
+        using NumPy to draw the random numbers of many passwords at
+        once. Generators not supporting it (or if NumPy is not
+        available) use get_random_passwords."""
+        return self.get_random_passwords(count, n)
 
     def get_password(self, name, username, nonce, passphrase):
         """Returns the next secure password of length n given by the
@@ -71,6 +143,28 @@ class PasswordGenerator:
         nonce. This is an abstract method that needs to be overriden."""
         pass
 
+    def prepare(self, passphrase):
+        """Returns a function returning the password of length n for a
+        name, username and nonce (in this order) with the passphrase.
+        It is used to generate several passwords with the same
+        passphrase and may be overriden to do the work depending only
+        of the passphrase once."""
+        def derive(name, username, nonce, n):
+            return self.get_password(name, username, nonce, passphrase, n)
+        return derive
+
+    def __eq__(self, other):
+        """Returns true if both objects are PasswordGenerators with the
+        same fingerprint (i.e. they generate the same passwords)."""
+        return isinstance(other, PasswordGenerator) and \
+               self.fingerprint == other.fingerprint
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.fingerprint)
+
 class PassmanGenerator(PasswordGenerator):
     """A PasswordGenerator is an object used to generate a
     pseudo-random password which can be secure. It allows to generate
@@ -86,13 +180,22 @@ class PassmanGenerator(PasswordGenerator):
         - the name of the file with each line containing each symbol
         - the hash algorithm name (default is SHA-512)
         The result of the secure password will depend of the symbols
-        order in the file."""
+        order in the file. The symbols are loaded from a compiled and
+        memory-mapped version of the file (see symbols.load)."""
         self.filename = filename
-        with open(filename) as f:
-            self.symbols = [l.strip() for l in f.readlines()
-                            if len(l.strip()) > 0]
+        self.symbols = symbols.load(filename)
         self.sep = sep
         self.algo = algo
+        self.fingerprint = self.get_fingerprint()
+
+    def get_fingerprint(self):
+        """Returns the fingerprint of the generator computed from the
+        kind of generator, the algorithm, the separator and the
+        symbols."""
+        fingerprint = hashlib.sha1(self.yaml_tag)
+        for data in [self.algo, self.sep, symbols.get_digest(self.symbols)]:
+            fingerprint.update("\0" + data)
+        return fingerprint.hexdigest()
 
     def get_entropy(self, length):
         """Returns the entropy for a given length."""
@@ -102,35 +205,270 @@ class PassmanGenerator(PasswordGenerator):
         """Returns the length to have password for a given entropy."""
         return math.log(2 ** entropy, len(self.symbols))
 
-    def next_symbol(self):
-        """Returns the next symbol given by the generator."""
-        return random.choice(self.symbols)
+    def next_symbol(self, rng=random):
+        """Returns the next symbol given by the generator using the
+        pseudo-random generator rng."""
+        return rng.choice(self.symbols)
 
-    def get_next_password(self, n=15):
+    def get_next_password(self, n=15, rng=random):
         """Returns the next password given of length n (15 by default)
-        by the generator."""
-        return self.sep.join((self.next_symbol() for i in xrange(n)))
+        by the generator using the pseudo-random generator rng."""
+        return self.sep.join((self.next_symbol(rng) for i in xrange(n)))
+
+    def get_random_passwords(self, count, n=15):
+        """Yields count random passwords of length n (15 by default)
+        using a BufferedSystemRandom. The symbols are copied once in a
+        list for the whole set of passwords."""
+        symbols = list(self.symbols)
+        choice = BufferedSystemRandom().choice
+        for i in xrange(count):
+            yield self.sep.join([choice(symbols) for j in xrange(n)])
+
+    def get_random_indexes(self, count):
+        """Returns a NumPy array of count symbol indexes drawn from
+        os.urandom. Values that would bias the choice of the symbols
+        are rejected."""
+        m = len(self.symbols)
+        size = 1 if m <= 2 ** 8 else 2 if m <= 2 ** 16 else 4
+        space = 256 ** size
+        limit = space - space % m
+        dtype = numpy.dtype(">u{}".format(size))
+        indexes = numpy.empty(0, dtype=numpy.int64)
+        while len(indexes) < count:
+            missing = count - len(indexes)
+            draw = int(missing * float(space) / limit * 1.05) + 16
+            values = numpy.frombuffer(os.urandom(draw * size), dtype=dtype)
+            values = values[values < limit] % m
+            indexes = numpy.concatenate([indexes, values])
+        return indexes[:count]
+
+    def get_vectorized_random_passwords(self, count, n=15, block=65536):
+        """Yields count random passwords of length n (15 by default).
+        The symbol indexes of up to block passwords are drawn at once
+        with NumPy as a matrix. Falls back to get_random_passwords if
+        NumPy is not available."""
+        if numpy is None:
+            for password in self.get_random_passwords(count, n):
+                yield password
+            return
+        symbols = list(self.symbols)
+        chars = not self.sep and all(len(s) == 1 for s in symbols)
+        if chars:
+            table = numpy.frombuffer("".join(symbols), dtype="S1")
+        else:
+            table = numpy.array(symbols, dtype=object)
+        while count > 0:
+            rows = min(block, count)
+            indexes = self.get_random_indexes(rows * n).reshape(rows, n)
+            matrix = table[indexes]
+            if chars:
+                matrix = numpy.ascontiguousarray(matrix)
+                for password in matrix.view("S{}".format(n)).ravel():
+                    yield str(password)
+            else:
+                for row in matrix.tolist():
+                    yield self.sep.join(row)
+            count -= rows
 
     def get_password(self, name, username, nonce, passphrase, n):
         """Returns the next secure password of length n given by the
         generator depending of the passphrase, name, username and
-        nonce."""
-        state = random.getstate()
+        nonce. The seed is given to a private random.Random instance
+        so this method is reentrant and can be used from several
+        threads at once."""
         string = name + username + nonce + passphrase
         seed = hashlib.new(self.algo, string).digest()
-        random.seed(seed)
-        password = self.get_next_password(n)
-        random.setstate(state)
-        return password
+        return self.get_next_password(n, random.Random(seed))
+
+class PassphraseFirstGenerator(PassmanGenerator):
+    """A PassphraseFirstGenerator is a PassmanGenerator hashing the
+    passphrase before the name, username and nonce. The state of the
+    hash after the passphrase is kept (see prepare) so the passphrase
+    is hashed only once when several passwords are generated."""
+    yaml_tag = u'!PassphraseFirstGenerator'
+
+    def prepare(self, passphrase):
+        """Returns a function returning the password of length n for a
+        name, username and nonce. The passphrase is hashed once and a
+        copy of the hash object is used for each password."""
+        prefix = hashlib.new(self.algo, passphrase)
+        def derive(name, username, nonce, n):
+            h = prefix.copy()
+            h.update(name + username + nonce)
+            return self.get_next_password(n, random.Random(h.digest()))
+        return derive
 
-    def __eq__(self, other):
-        """Returns true if both objects are the same PasswordGenerator
-        (using the same symbols and same algorithm)."""
-        if isinstance(other, self.__class__):
-            return self.symbols == other.symbols and \
-                   self.sep == other.sep and self.algo == other.algo
-        else:
-            return True
+    def get_password(self, name, username, nonce, passphrase, n):
+        """Returns the next secure password of length n given by the
+        generator depending of the passphrase, name, username and
+        nonce."""
+        return self.prepare(passphrase)(name, username, nonce, n)
+
+class HKDFGenerator(PassmanGenerator):
+    """An HKDFGenerator is a PassmanGenerator which doesn't use
+    Python's pseudo-random generator to choose the symbols. The
+    passphrase, name, username and nonce are given to HKDF (RFC 5869)
+    using HMAC with the hash algorithm (SHA-512 by default) and its
+    output stream is directly mapped to symbol indexes using
+    rejection sampling so that each symbol is equally likely."""
+    yaml_tag = u'!HKDFGenerator'
+
+    ipad = "".join(chr(x ^ 0x36) for x in xrange(256))
+    opad = "".join(chr(x ^ 0x5C) for x in xrange(256))
+    index_formats = {1: "B", 2: "H", 4: "I"}
+
+    def __init__(self, filename, algo="sha512", sep=""):
+        """Initializes the generator like a PassmanGenerator."""
+        PassmanGenerator.__init__(self, filename, algo, sep)
+        self.hash = hashlib.new(algo)
+        self.index_size = 1
+        while 256 ** self.index_size < len(self.symbols):
+            self.index_size += 1
+        size = 256 ** self.index_size
+        self.index_limit = size - size % len(self.symbols)
+
+    def hmac(self, key, msg):
+        """Returns the HMAC digest of msg using the hash algorithm."""
+        if len(key) > self.hash.block_size:
+            key = self.new_hash(key).digest()
+        key = key.ljust(self.hash.block_size, "\0")
+        inner = self.new_hash(key.translate(self.ipad) + msg).digest()
+        return self.new_hash(key.translate(self.opad) + inner).digest()
+
+    def new_hash(self, data):
+        """Returns a new hash object for the hash algorithm."""
+        h = self.hash.copy()
+        h.update(data)
+        return h
+
+    def get_key(self, passphrase, salt=""):
+        """Returns the pseudo-random key extracted (HKDF-Extract) from
+        the passphrase."""
+        return self.hmac(salt, passphrase)
+
+    def expand(self, key, info):
+        """Yields the blocks of the output stream (HKDF-Expand) of the
+        pseudo-random key for the info string. Raises a ValueError
+        when the maximum output length of HKDF has been reached."""
+        block = ""
+        for i in xrange(1, 256):
+            block = self.hmac(key, block + info + chr(i))
+            yield block
+        raise ValueError("HKDF output stream exhausted")
+
+    def get_indexes(self, blocks, n):
+        """Returns a list of n symbol indexes read from an iterable of
+        byte strings. Values that would bias the choice of the symbols
+        are rejected."""
+        indexes = []
+        size = self.index_size
+        buf = ""
+        for block in blocks:
+            buf += block
+            end = len(buf) - len(buf) % size
+            if size in self.index_formats:
+                fmt = ">{}{}".format(end / size, self.index_formats[size])
+                values = struct.unpack(fmt, buf[:end])
+            else:
+                values = [int(buf[i:i + size].encode("hex"), 16)
+                          for i in xrange(0, end, size)]
+            buf = buf[end:]
+            for value in values:
+                if value < self.index_limit:
+                    indexes.append(value % len(self.symbols))
+                    if len(indexes) == n:
+                        return indexes
+        return indexes
+
+    def get_random_password(self, n=15):
+        """Returns a random password of length n (15 by default) using
+        bytes obtained with os.urandom."""
+        blocks = iter(lambda: os.urandom(self.hash.digest_size), None)
+        return self.sep.join(self.symbols[i]
+                             for i in self.get_indexes(blocks, n))
+
+    def get_random_passwords(self, count, n=15):
+        """Yields count random passwords of length n (15 by default)
+        using bytes read from a BufferedSystemRandom."""
+        rng = BufferedSystemRandom()
+        blocks = iter(lambda: rng.read(self.hash.digest_size), None)
+        for i in xrange(count):
+            yield self.sep.join(self.symbols[i]
+                                for i in self.get_indexes(blocks, n))
+
+    def get_key_password(self, key, info, n):
+        """Returns the password of length n mapped from the output
+        stream of the key for the info string."""
+        indexes = self.get_indexes(self.expand(key, info), n)
+        return self.sep.join(self.symbols[i] for i in indexes)
+
+    def prepare(self, passphrase):
+        """Returns a function returning the password of length n for a
+        name, username and nonce. The key is only extracted once from
+        the passphrase."""
+        key = self.get_key(passphrase)
+        def derive(name, username, nonce, n):
+            info = "\0".join([name, username, nonce])
+            return self.get_key_password(key, info, n)
+        return derive
+
+    def get_password(self, name, username, nonce, passphrase, n):
+        """Returns the secure password of length n given by the
+        generator depending of the passphrase, name, username and
+        nonce."""
+        return self.prepare(passphrase)(name, username, nonce, n)
+
+class PBKDF2Generator(HKDFGenerator):
+    """A PBKDF2Generator is an HKDFGenerator using a key derived from
+    the passphrase with PBKDF2 (salted with the name, username and
+    nonce) and a tunable number of iterations. This makes each
+    password (and each attempt of an offline brute force attack on
+    the passphrase) expensive to compute. The algorithm's name is the
+    hash algorithm's name and the number of iterations separated by a
+    dash (e.g. sha512-100000)."""
+    yaml_tag = u'!PBKDF2Generator'
+
+    def __init__(self, filename, algo="sha512-100000", sep=""):
+        """Initializes the generator like an HKDFGenerator. Raises a
+        ValueError if the number of iterations is invalid."""
+        hash_name, iterations = algo.rsplit("-", 1)
+        self.iterations = int(iterations)
+        if self.iterations < 1:
+            raise ValueError("Invalid number of iterations")
+        HKDFGenerator.__init__(self, filename, hash_name, sep)
+
+    def get_fingerprint(self):
+        """Returns the fingerprint of the generator which also depends
+        of the number of iterations."""
+        fingerprint = hashlib.sha1(HKDFGenerator.get_fingerprint(self))
+        fingerprint.update("\0{}".format(self.iterations))
+        return fingerprint.hexdigest()
+
+    def prepare(self, passphrase):
+        """Returns a function returning the password of length n for a
+        name, username and nonce. The key is derived for each password
+        as the name, username and nonce are used as salt."""
+        def derive(name, username, nonce, n):
+            info = "\0".join([name, username, nonce])
+            key = hashlib.pbkdf2_hmac(self.algo, passphrase, info,
+                                      self.iterations)
+            return self.get_key_password(key, info, n)
+        return derive
+
+def calibrate_pbkdf2(hash_name="sha512", target=0.1, step=1000):
+    """Returns the number of PBKDF2 iterations (rounded to a multiple
+    of step) needed to derive a key in target seconds with the hash
+    algorithm on this machine."""
+    iterations = step
+    while True:
+        start = time.time()
+        hashlib.pbkdf2_hmac(hash_name, "passphrase", "salt", iterations)
+        elapsed = time.time() - start
+        if elapsed >= min(target, 0.05):
+            break
+        iterations *= 2
+    iterations = int(iterations * target / elapsed)
+    return max(step, iterations - iterations % step)
 
 class OplopGenerator(PasswordGenerator):
     """Generates passwords using the Oplop's algorithm
@@ -147,12 +485,12 @@ class OplopGenerator(PasswordGenerator):
         """Returns the length to have password for a given entropy."""
         return math.log(2 ** entropy / 10., 64) + 1
 
-    def get_next_password(self, n=8):
+    def get_next_password(self, n=8, rng=random):
         """Returns the next password given of length n (8 by default)
-        by the generator."""
-        username = "".join([chr(33 + random.randrange(94)) \
+        by the generator using the pseudo-random generator rng."""
+        username = "".join([chr(33 + rng.randrange(94)) \
                             for i in xrange(n)])
-        passphrase = "".join([chr(33 + random.randrange(94)) \
+        passphrase = "".join([chr(33 + rng.randrange(94)) \
                               for i in xrange(n)])
         return self.get_password("", username, "", passphrase, n)
 
@@ -185,12 +523,12 @@ class SuperGenPassGenerator(PasswordGenerator):
         return math.log(2 ** entropy / 10., 64) + 1
         pass
 
-    def get_next_password(self, n=8):
+    def get_next_password(self, n=8, rng=random):
         """Returns the next password given of length n (8 by default)
-        by the generator."""
-        website = "".join([chr(33 + random.randrange(94)) \
+        by the generator using the pseudo-random generator rng."""
+        website = "".join([chr(33 + rng.randrange(94)) \
                            for i in xrange(n)])
-        passphrase = "".join([chr(33 + random.randrange(94)) \
+        passphrase = "".join([chr(33 + rng.randrange(94)) \
                               for i in xrange(n)])
         return self.get_password(name, "", "", passphrase, n)
 
@@ -229,12 +567,12 @@ class PasswordComposerGenerator(PasswordGenerator):
         return math.log(2 ** entropy / 10., 64) + 1
         pass
 
-    def get_next_password(self, n=8):
+    def get_next_password(self, n=8, rng=random):
         """Returns the next password given of length n (8 by default)
-        by the generator."""
-        website = "".join([chr(33 + random.randrange(94)) \
+        by the generator using the pseudo-random generator rng."""
+        website = "".join([chr(33 + rng.randrange(94)) \
                            for i in xrange(n)])
-        passphrase = "".join([chr(33 + random.randrange(94)) \
+        passphrase = "".join([chr(33 + rng.randrange(94)) \
                               for i in xrange(n)])
         return self.get_password(name, "", "", passphrase, n)
 
@@ -245,6 +583,55 @@ class PasswordComposerGenerator(PasswordGenerator):
         sha1.update(passphrase + ":" + name)
         return base64.b64encode(sha1.digest())[:n-2] + "1a"
 
+class GeneratorCache:
+    """A GeneratorCache is a size-bounded cache of PassmanGenerators
+    shared by GeneratorManagers. When it is full, the least recently
+    used generator is evicted. The number of hits and misses are
+    counted. It can be used from several threads."""
+
+    def __init__(self, size=16):
+        """Initializes an empty cache holding at most size
+        generators."""
+        self.size = size
+        self.generators = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, factory):
+        """Returns the generator associated with the key. If it is not
+        in the cache, it is created by calling factory and added in
+        the cache. If a cached generator has the same fingerprint,
+        it is used instead of the new one."""
+        with self.lock:
+            if key in self.generators:
+                generator = self.generators.pop(key)
+                self.generators[key] = generator
+                self.hits += 1
+                return generator
+            self.misses += 1
+        generator = factory()
+        with self.lock:
+            for g in self.generators.itervalues():
+                if g == generator:
+                    generator = g
+                    break
+            self.generators[key] = generator
+            while len(self.generators) > self.size:
+                self.generators.popitem(last=False)
+        return generator
+
+    def clear(self):
+        """Removes all the generators from the cache and resets the
+        counters."""
+        with self.lock:
+            self.generators.clear()
+            self.hits = 0
+            self.misses = 0
+
+# Cache shared by all the GeneratorManagers of the process.
+generator_cache = GeneratorCache()
+
 class GeneratorManager:
     """A GeneratorManager is used to manage the different
     PasswordGenerators.  It's main use is for loading into memory only
@@ -252,10 +639,22 @@ class GeneratorManager:
     SuperGenPass and PasswordComposer managers."""
     yaml_tag = u'!GeneratorManager'
 
-    def __init__(self, directory):
+    # PassmanGenerator subclasses selected by the prefix of the
+    # algorithm's name (e.g. hkdf-sha512:ascii).
+    families = {
+        "passfirst": PassphraseFirstGenerator,
+        "hkdf": HKDFGenerator,
+        "pbkdf2": PBKDF2Generator
+        }
+
+    def __init__(self, directory, cache=None):
         """Initializes the manager with the path name of the directory
-        which contains the symbol's size for the PassmanGenerators."""
+        which contains the symbol's size for the PassmanGenerators.
+        PassmanGenerators are stored in the GeneratorCache cache
+        (generator_cache, shared by all the managers, by default) and
+        the generator of each name is also kept by the manager."""
         self.directory = directory
+        self.cache = cache if cache else generator_cache
         self.generators = {
             "oplop": OplopGenerator(),
             "supergenpass": SuperGenPassGenerator(),
@@ -269,14 +668,31 @@ class GeneratorManager:
         algorithm's name and the symbol's filename separated by a
         colon. For example: sha512:ascii will use SHA-512 as the hash
         algorithm and the ascii file containing 94 usable ASCII
-        characters."""
-        if name == "oplop" or name == "supergenpass" or \
-               name == "passwordcomposer":
+        characters. The algorithm's name may be prefixed by a generator
+        family and a dash to use another kind of PassmanGenerator. For
+        example: hkdf-sha512:ascii uses an HKDFGenerator and
+        pbkdf2-sha512-100000:ascii uses a PBKDF2Generator with 100000
+        iterations. Raises a ValueError if the family is unknown.
+        PassmanGenerators are looked up in the cache using the
+        generator's kind and the identity of the symbols file the
+        first time a name is used by the manager."""
+        if name in self.generators:
             return self.generators[name]
         else:
-            if name not in self.generators:
-                algo, filename = name.split(":", 1)
-                sep = " " if filename.startswith("diceware") else ""
-                filename = os.path.join(self.directory, filename)
-                self.generators[name] = PassmanGenerator(filename, algo, sep)
-            return self.generators[name]
+            algo, filename = name.split(":", 1)
+            generator_class = PassmanGenerator
+            if "-" in algo:
+                family, algo = algo.split("-", 1)
+                if family not in self.families:
+                    raise ValueError("Unknown generator family")
+                generator_class = self.families[family]
+            sep = " " if filename.startswith("diceware") else ""
+            filename = os.path.realpath(os.path.join(self.directory,
+                                                     filename))
+            stat = os.stat(filename)
+            key = (generator_class, algo, sep, filename,
+                   stat.st_mtime, stat.st_size)
+            generator = self.cache.get(key, lambda: generator_class(
+                filename, algo, sep))
+            self.generators[name] = generator
+            return generator
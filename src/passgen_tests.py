@@ -15,13 +15,44 @@
 # You should have received a copy of the GNU General Public License
 # along with PassMAN.  If not, see <http://www.gnu.org/licenses/>.
 
-import unittest, random, os
+import unittest, random, os, threading
 import passgen
 
 def generate_default_symbols(filename):
     with open(filename, 'w') as f:
         f.write("\n".join([chr(33 + i) for i in xrange(94)]))
 
+def remove_symbols(filename):
+    os.remove(filename)
+    if os.path.exists(filename + ".sym"):
+        os.remove(filename + ".sym")
+
+class TestBufferedSystemRandom(unittest.TestCase):
+    def setUp(self):
+        self.rng = passgen.BufferedSystemRandom(64)
+
+    def test_read(self):
+        data = [self.rng.read(7) for i in xrange(100)]
+        self.assertTrue(all(len(d) == 7 for d in data))
+        self.assertEqual(len(self.rng.read(1000)), 1000)
+
+    def test_random(self):
+        for i in xrange(1000):
+            x = self.rng.random()
+            self.assertTrue(0 <= x < 1)
+            self.assertTrue(0 <= self.rng.getrandbits(5) < 32)
+            self.assertTrue(0 <= self.rng.randrange(94) < 94)
+        self.assertRaises(ValueError, self.rng.getrandbits, 0)
+
+    def test_random_buffer(self):
+        reads = []
+        read = self.rng.read
+        self.rng.read = lambda n: reads.append(n) or read(n)
+        self.rng.random()
+        self.rng.getrandbits(5)
+        self.assertEqual(reads, [64, 1])
+        self.assertEqual(len(self.rng.floats), 7)
+
 class TestOplopGenerator(unittest.TestCase):
     entropy_test_limit = 24 # Bigger than 24 => useless/impossible
 
@@ -30,7 +61,7 @@ class TestOplopGenerator(unittest.TestCase):
         self.generator = passgen.OplopGenerator()
 
     def tearDown(self):
-        os.remove("test_symbols")
+        remove_symbols("test_symbols")
 
     def test_entropy(self):
         for i in xrange(1, self.entropy_test_limit + 1):
@@ -75,7 +106,7 @@ class TestSuperGenPassGenerator(unittest.TestCase):
         self.generator = passgen.SuperGenPassGenerator()
 
     def tearDown(self):
-        os.remove("test_symbols")
+        remove_symbols("test_symbols")
 
     def test_entropy(self):
         for i in xrange(1, self.entropy_test_limit + 1):
@@ -101,7 +132,7 @@ class TestPasswordComposerGenerator(unittest.TestCase):
         self.generator = passgen.PasswordComposerGenerator()
 
     def tearDown(self):
-        os.remove("test_symbols")
+        remove_symbols("test_symbols")
 
     def test_entropy(self):
         for i in xrange(1, self.entropy_test_limit + 1):
@@ -127,7 +158,7 @@ class TestPassmanGenerator(unittest.TestCase):
         random.seed(0)
 
     def tearDown(self):
-        os.remove("test_symbols")
+        remove_symbols("test_symbols")
 
     def test_symbol(self):
         symbol = self.generator.next_symbol()
@@ -156,5 +187,262 @@ class TestPassmanGenerator(unittest.TestCase):
         next_password = self.generator.get_next_password()
         self.assertEqual(next_password, "phH9QGj=MWvP;h[")
 
+    def test_secure_password_threads(self):
+        results = []
+        def derive():
+            for i in xrange(50):
+                results.append(self.generator.get_password("name",
+                                                           "username",
+                                                           "nonce",
+                                                           "passphrase",
+                                                           15))
+        threads = [threading.Thread(target=derive) for i in xrange(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(set(results), set(["~T'pIAM+vyZ[,7T"]))
+        self.assertEqual(len(results), 200)
+
+    def test_fingerprint(self):
+        generate_default_symbols("test_symbols2")
+        generator = passgen.PassmanGenerator("test_symbols2")
+        remove_symbols("test_symbols2")
+        self.assertEqual(self.generator.fingerprint, generator.fingerprint)
+        self.assertEqual(self.generator, generator)
+        self.assertNotEqual(self.generator,
+                            passgen.PassmanGenerator("test_symbols",
+                                                     "sha256"))
+        self.assertNotEqual(self.generator,
+                            passgen.PassmanGenerator("test_symbols",
+                                                     sep=" "))
+        self.assertNotEqual(self.generator,
+                            passgen.HKDFGenerator("test_symbols"))
+        self.assertNotEqual(self.generator, passgen.OplopGenerator())
+        self.assertNotEqual(self.generator, "sha512:test_symbols")
+
+    def test_random_password(self):
+        state = random.getstate()
+        password = self.generator.get_random_password(20)
+        self.assertEqual(len(password), 20)
+        self.assertEqual(random.getstate(), state)
+
+    def test_random_passwords(self):
+        passwords = list(self.generator.get_random_passwords(100, 20))
+        self.assertEqual(len(passwords), 100)
+        self.assertEqual(len(set(passwords)), 100)
+        self.assertTrue(all(len(p) == 20 for p in passwords))
+
+    @unittest.skipIf(passgen.numpy is None, "NumPy is not available")
+    def test_vectorized_random_passwords(self):
+        passwords = self.generator.get_vectorized_random_passwords(100, 20,
+                                                                   block=30)
+        passwords = list(passwords)
+        self.assertEqual(len(set(passwords)), 100)
+        self.assertTrue(all(isinstance(p, str) for p in passwords))
+        self.assertTrue(all(len(p) == 20 for p in passwords))
+        self.assertTrue(all(c in self.generator.symbols
+                            for p in passwords for c in p))
+        generate_default_symbols("test_symbols2")
+        generator = passgen.PassmanGenerator("test_symbols2", sep=" ")
+        remove_symbols("test_symbols2")
+        passwords = list(generator.get_vectorized_random_passwords(10, 5))
+        self.assertTrue(all(len(p.split(" ")) == 5 for p in passwords))
+
+    @unittest.skipIf(passgen.numpy is None, "NumPy is not available")
+    def test_random_indexes(self):
+        indexes = self.generator.get_random_indexes(94 * 200)
+        self.assertEqual(len(indexes), 94 * 200)
+        self.assertEqual(set(indexes), set(xrange(94)))
+
+    def test_vectorized_fallback(self):
+        numpy = passgen.numpy
+        passgen.numpy = None
+        try:
+            passwords = self.generator.get_vectorized_random_passwords(10)
+            self.assertEqual(len(list(passwords)), 10)
+        finally:
+            passgen.numpy = numpy
+
+class TestPassphraseFirstGenerator(unittest.TestCase):
+    def setUp(self):
+        generate_default_symbols("test_symbols")
+        self.generator = passgen.PassphraseFirstGenerator("test_symbols")
+
+    def tearDown(self):
+        remove_symbols("test_symbols")
+
+    def test_secure_password(self):
+        # Same hashed string as a PassmanGenerator with the passphrase
+        # passed as name
+        generator = passgen.PassmanGenerator("test_symbols")
+        self.assertEqual(self.generator.get_password("name", "username",
+                                                     "nonce", "passphrase",
+                                                     15),
+                         generator.get_password("passphrase", "name",
+                                                "username", "nonce", 15))
+
+    def test_prepare(self):
+        derive = self.generator.prepare("passphrase")
+        for name in ["name1", "name2", "name1"]:
+            self.assertEqual(derive(name, "username", "nonce", 15),
+                             self.generator.get_password(name, "username",
+                                                         "nonce",
+                                                         "passphrase", 15))
+
+class TestHKDFGenerator(unittest.TestCase):
+    def setUp(self):
+        generate_default_symbols("test_symbols")
+        with open("test_words", 'w') as f:
+            f.write("\n".join(["w{}".format(i) for i in xrange(300)]))
+        self.generator = passgen.HKDFGenerator("test_symbols")
+
+    def tearDown(self):
+        remove_symbols("test_symbols")
+        remove_symbols("test_words")
+
+    def test_secure_password(self):
+        secure_password = self.generator.get_password("name", "username",
+                                                      "nonce", "passphrase",
+                                                      15)
+        self.assertEqual(secure_password, "'-uA3j2\\p1l,A\"?")
+        secure_password = self.generator.get_password("name", "username",
+                                                      "nonce2", "passphrase",
+                                                      15)
+        self.assertEqual(secure_password, "A~?ElGE\"U$E5(e5")
+
+    def test_secure_password_words(self):
+        generator = passgen.HKDFGenerator("test_words", sep=" ")
+        self.assertEqual(generator.index_size, 2)
+        secure_password = generator.get_password("name", "username",
+                                                 "nonce", "passphrase", 5)
+        self.assertEqual(secure_password, "w22 w156 w162 w202 w0")
+
+    def test_prepare(self):
+        derive = self.generator.prepare("passphrase")
+        self.assertEqual(derive("name", "username", "nonce", 15),
+                         "'-uA3j2\\p1l,A\"?")
+        self.assertEqual(derive("name", "username", "nonce2", 15),
+                         "A~?ElGE\"U$E5(e5")
+
+    def test_random_password(self):
+        password = self.generator.get_random_password(64)
+        self.assertEqual(len(password), 64)
+        self.assertTrue(all(c in self.generator.symbols for c in password))
+
+    def test_random_passwords(self):
+        passwords = list(self.generator.get_random_passwords(100, 20))
+        self.assertEqual(len(set(passwords)), 100)
+        self.assertTrue(all(len(p) == 20 for p in passwords))
+
+    def test_generator_manager(self):
+        manager = passgen.GeneratorManager(".")
+        generator = manager.get_generator("hkdf-sha512:test_symbols")
+        self.assertTrue(isinstance(generator, passgen.HKDFGenerator))
+        generator = manager.get_generator("sha512:test_symbols")
+        self.assertFalse(isinstance(generator, passgen.HKDFGenerator))
+        self.assertRaises(ValueError, manager.get_generator,
+                          "unknown-sha512:test_symbols")
+
+class TestPBKDF2Generator(unittest.TestCase):
+    def setUp(self):
+        generate_default_symbols("test_symbols")
+        self.generator = passgen.PBKDF2Generator("test_symbols",
+                                                 "sha512-1000")
+
+    def tearDown(self):
+        remove_symbols("test_symbols")
+
+    def test_secure_password(self):
+        secure_password = self.generator.get_password("name", "username",
+                                                      "nonce", "passphrase",
+                                                      15)
+        self.assertEqual(secure_password, "SfxL@RrOKwrnD(E")
+
+    def test_iterations(self):
+        generator = passgen.PBKDF2Generator("test_symbols", "sha512-2000")
+        self.assertEqual(generator.iterations, 2000)
+        self.assertNotEqual(self.generator, generator)
+        self.assertNotEqual(self.generator.get_password("name", "username",
+                                                        "nonce",
+                                                        "passphrase", 15),
+                            generator.get_password("name", "username",
+                                                   "nonce", "passphrase",
+                                                   15))
+        self.assertRaises(ValueError, passgen.PBKDF2Generator,
+                          "test_symbols", "sha512")
+        self.assertRaises(ValueError, passgen.PBKDF2Generator,
+                          "test_symbols", "sha512-0")
+
+    def test_generator_manager(self):
+        manager = passgen.GeneratorManager(".")
+        generator = manager.get_generator("pbkdf2-sha512-1000:test_symbols")
+        self.assertEqual(generator, self.generator)
+
+    def test_calibrate(self):
+        iterations = passgen.calibrate_pbkdf2("sha512", 0.01, 100)
+        self.assertTrue(iterations >= 100)
+        self.assertEqual(iterations % 100, 0)
+
+class TestGeneratorCache(unittest.TestCase):
+    def setUp(self):
+        generate_default_symbols("test_symbols")
+        generate_default_symbols("test_symbols2")
+        with open("test_symbols3", 'w') as f:
+            f.write("\n".join(["a", "b", "c"]))
+        self.cache = passgen.GeneratorCache(1)
+
+    def tearDown(self):
+        remove_symbols("test_symbols")
+        remove_symbols("test_symbols2")
+        remove_symbols("test_symbols3")
+
+    def test_shared(self):
+        manager1 = passgen.GeneratorManager(".", self.cache)
+        manager2 = passgen.GeneratorManager(".", self.cache)
+        generator = manager1.get_generator("sha512:test_symbols")
+        self.assertTrue(generator is
+                        manager2.get_generator("sha512:test_symbols"))
+        self.assertEqual(self.cache.misses, 1)
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_eviction(self):
+        manager = passgen.GeneratorManager(".", self.cache)
+        generator = manager.get_generator("sha512:test_symbols")
+        manager.get_generator("sha512:test_symbols3")
+        self.assertEqual(len(self.cache.generators), 1)
+        self.assertTrue(generator is
+                        manager.get_generator("sha512:test_symbols"))
+        manager = passgen.GeneratorManager(".", self.cache)
+        self.assertFalse(generator is
+                         manager.get_generator("sha512:test_symbols"))
+        self.assertEqual(self.cache.misses, 3)
+        self.assertEqual(self.cache.hits, 0)
+
+    def test_memoized(self):
+        manager = passgen.GeneratorManager(".", self.cache)
+        generator = manager.get_generator("sha512:test_symbols")
+        os.remove("test_symbols")
+        self.assertTrue(generator is
+                        manager.get_generator("sha512:test_symbols"))
+        generate_default_symbols("test_symbols")
+        self.assertEqual(self.cache.misses, 1)
+        self.assertEqual(self.cache.hits, 0)
+
+    def test_same_fingerprint(self):
+        manager = passgen.GeneratorManager(".", passgen.GeneratorCache())
+        generator = manager.get_generator("sha512:test_symbols")
+        self.assertTrue(generator is
+                        manager.get_generator("sha512:test_symbols2"))
+        self.assertEqual(len(manager.cache.generators), 2)
+
+    def test_algorithms(self):
+        manager = passgen.GeneratorManager(".", passgen.GeneratorCache())
+        generator = manager.get_generator("sha512:test_symbols")
+        self.assertFalse(generator is
+                         manager.get_generator("sha256:test_symbols"))
+        self.assertFalse(generator is
+                         manager.get_generator("hkdf-sha512:test_symbols"))
+
 if __name__ == '__main__':
     unittest.main()
@@ -15,9 +15,28 @@
 # You should have received a copy of the GNU General Public License
 # along with PassMAN.  If not, see <http://www.gnu.org/licenses/>.
 
-import yaml, re
+import yaml, re, heapq, bisect, shlex, binascii, weakref, array, string, \
+    operator, itertools
 import passgen
 
+# Interned sets of tags shared by the entries (see
+# PasswordEntry.__setattr__). A set is dropped once no entry uses it.
+interned_tags = weakref.WeakValueDictionary()
+
+def intern_string(s):
+    """Returns the interned copy of a byte string (see the built-in
+    intern). Unicode strings are returned as is."""
+    return intern(s) if type(s) is str else s
+
+def intern_tags(tags):
+    """Returns the interned frozenset of an iterable of tags."""
+    tags = frozenset(tags)
+    interned = interned_tags.get(tags)
+    if interned is None:
+        interned = frozenset(intern_string(t) for t in tags)
+        interned_tags[tags] = interned
+    return interned
+
 class PasswordEntry(yaml.YAMLObject):
     """A PasswordEntry is an entry for a password in the manager. It
     has a name, a username, a nonce, a length and an optional comment.
@@ -26,11 +45,29 @@ class PasswordEntry(yaml.YAMLObject):
     entry is associated with a set of tags. The entry is also
     identified by the kind of generator (symbols set and hash
     algorithm). It is possible to define either the length or the
-    minimum entropy. By default uses a length of 15."""
+    minimum entropy. By default uses a length of 15. The fingerprint
+    of the generator is recorded the first time a password is
+    generated to detect a change of its symbols.
+
+    Entries use slots to be compact in memory. Their generator name
+    is interned and their tags are an interned frozenset (so the set
+    of tags must be replaced to be modified)."""
     yaml_tag = u'!PasswordEntry'
 
+    # Serialized attributes and their default value for the entries
+    # saved by older versions.
+    defaults = [("generator", None), ("name", None), ("username", None),
+                ("comment", ""), ("nonce", ""), ("length", 1),
+                ("entropy", None), ("tags", ()), ("fingerprint", None)]
+    __slots__ = ["generator", "name", "username", "comment", "nonce",
+                 "length", "entropy", "tags", "fingerprint", "_search_blob"]
+
+    # Attributes included in the search blob (see get_search_blob).
+    search_fields = frozenset(["name", "username", "nonce", "comment",
+                               "tags"])
+
     def __init__(self, generator, name, username, comment="", nonce="",
-                 length=1, entropy=None, tags=set()):
+                 length=1, entropy=None, tags=None, fingerprint=None):
         """Initializes the entry with the parameters. It is possible
         to define a minimum entropy, in this case the required minimum
         length will be also computed."""
@@ -41,19 +78,33 @@ class PasswordEntry(yaml.YAMLObject):
         self.comment = comment
         self.length = length
         self.entropy = entropy
-        self.tags = tags
+        self.tags = tags or ()
+        self.fingerprint = fingerprint
 
     def get_password(self, generator_manager, passphrase):
         """Returns the Password object that can generate the password
         for this entry using a given generator_manager and a
         passphrase."""
         generator = generator_manager.get_generator(self.generator)
+        return self.derive_password(generator, generator.prepare(passphrase))
+
+    def derive_password(self, generator, derive):
+        """Returns the password for this entry using an already
+        resolved PasswordGenerator instance and the function returned
+        by its prepare method for the passphrase."""
         if self.entropy:
             self.length = max(generator.get_minimum_length(self.entropy),
                               self.length)
             self.entropy = None
-        return generator.get_password(self.name, self.username, self.nonce,
-                                      passphrase, self.length)
+        if not self.fingerprint:
+            self.fingerprint = generator.fingerprint
+        return derive(self.name, self.username, self.nonce, self.length)
+
+    def check_fingerprint(self, generator):
+        """Returns False if the fingerprint of the generator has
+        changed since it has been recorded."""
+        return not self.fingerprint or \
+               self.fingerprint == generator.fingerprint
 
     def get_entropy(self, generator_manager):
         """Returns the entropy of the password generated by this entry
@@ -77,12 +128,57 @@ class PasswordEntry(yaml.YAMLObject):
         s = "{} {}".format(s, self.comment) if self.comment else s
         return "{} {}".format(s, self.length)
 
+    def __setattr__(self, name, value):
+        if name == "tags":
+            value = intern_tags(value)
+        elif name == "generator" and value is not None:
+            value = intern_string(value)
+        object.__setattr__(self, name, value)
+        if name in PasswordEntry.search_fields:
+            object.__setattr__(self, "_search_blob", False)
+
+    def __getstate__(self):
+        """Returns the attributes to serialize (with YAML or pickle),
+        without the cached search blob. The tags are a set."""
+        state = dict((a, getattr(self, a))
+                     for a, default in PasswordEntry.defaults)
+        state["tags"] = set(self.tags)
+        return state
+
+    def __setstate__(self, state):
+        """Sets the serialized attributes. The missing ones get their
+        default value."""
+        for a, default in PasswordEntry.defaults:
+            setattr(self, a, state.get(a, default))
+
+    def get_search_blob(self):
+        """Returns the name, username, nonce, comment and tags of this
+        entry joined with newlines, so that a regular expression
+        compiled with re.M can be searched in all the fields at once.
+        The blob is cached until one of these attributes is replaced.
+        Returns None if a field contains a newline or if the fields
+        can't be joined, in this case each field must be searched."""
+        if self._search_blob is False:
+            fields = [self.name, self.username, self.nonce, self.comment]
+            fields.extend(sorted(self.tags))
+            try:
+                blob = "\n".join(fields)
+                if blob.count("\n") != len(fields) - 1:
+                    blob = None
+            except (TypeError, UnicodeError):
+                blob = None
+            object.__setattr__(self, "_search_blob", blob)
+        return self._search_blob
+
     def match_re(self, regex):
         """Returns True if the regular expression passed as parameter
         matches this entry name, username, nonce comment or a tag."""
-        for s in ([self.name, self.username, self.nonce, self.comment] +
-                  list(self.tags)):
-            if re.findall(regex, s):
+        search = re.compile(regex).search
+        for s in [self.name, self.username, self.nonce, self.comment]:
+            if search(s):
+                return True
+        for s in self.tags:
+            if search(s):
                 return True
         return False
 
@@ -90,78 +186,886 @@ class PasswordEntry(yaml.YAMLObject):
         """Returns True if this entry name, username, nonce, comment
         or a tag matches all of the keywords of the list passed as
         argument. The keywords are treated as regular expressions."""
+        return Filter(keywords).match(self)
+
+class Filter:
+    """A Filter is a list of keywords (regular expressions) compiled
+    once to be matched against many entries. An entry matches if each
+    keyword matches its name, username, nonce, comment or a tag.
+
+    Each keyword is searched in the search blob of the entry. A match
+    which doesn't contain a newline lies in a single field, so it is
+    also a match for this field. Otherwise or for the keywords whose
+    result may depend on the surrounding fields (\\A, \\Z and
+    lookarounds), the fields are searched one by one."""
+
+    unsafe = re.compile(r"\\[AZ]|\(\?[=!<]")
+
+    def __init__(self, keywords):
+        """Compiles the keywords. Raises re.error if a keyword isn't a
+        valid regular expression."""
+        self.patterns = []
         for k in keywords:
-            if not self.match_re(re.compile(k, re.I)):
+            field_re = re.compile(k, re.I)
+            if Filter.unsafe.search(k):
+                blob_re = None
+            else:
+                blob_re = re.compile(k, re.I | re.M)
+            self.patterns.append((field_re, blob_re))
+
+    def match(self, entry):
+        """Returns True if the entry matches all the keywords."""
+        if not self.patterns:
+            return True
+        blob = entry.get_search_blob()
+        for field_re, blob_re in self.patterns:
+            if blob is not None and blob_re is not None:
+                m = blob_re.search(blob)
+                if m is None:
+                    return False
+                if "\n" not in m.group():
+                    continue
+            if not entry.match_re(field_re):
                 return False
         return True
 
+# Keywords without regular expression metacharacters which can be
+# looked up in the trigram index.
+plain_keyword = re.compile(r"[^.^$*+?{}\[\]\\|()]{3,}\Z")
+
+trigram_re = re.compile(r"(?=(...))", re.S)
+
+def get_trigrams(s):
+    """Returns the set of the (lowercase) substrings of length 3 of a
+    string."""
+    return set(trigram_re.findall(s.lower()))
+
+def get_entry_trigrams(entry):
+    """Returns the set of the trigrams of the name, username, nonce,
+    comment and tags of an entry."""
+    trigrams = set()
+    for s in [entry.name, entry.username, entry.nonce, entry.comment]:
+        trigrams.update(get_trigrams(s))
+    for s in entry.tags:
+        trigrams.update(get_trigrams(s))
+    return trigrams
+
+class Query:
+    """A Query selects entries with terms separated by spaces (quotes
+    can be used for values containing spaces):
+
+    - tag:TAG, name:NAME, user:USERNAME, nonce:NONCE and comment:TEXT
+      match the entries whose field (or one of its tags) is equal to
+      the value, or matches it if the value is a /regex/ (case
+      insensitive).
+    - any other term is a keyword matched as by Filter (a regex on
+      all the fields, the slashes around it are optional).
+    - a term starting with - excludes the entries it matches.
+
+    An entry must match all the terms. Queries are run by
+    PasswordManager.query."""
+
+    fields = {"tag": "tags", "name": "name", "user": "username",
+              "username": "username", "nonce": "nonce",
+              "comment": "comment"}
+
+    def __init__(self, query):
+        """Parses the query. Raises re.error if a regex is invalid."""
+        self.terms = []
+        self.keywords = []
+        self.excluded = []
+        lexer = shlex.shlex(query, posix=True)
+        lexer.whitespace_split = True
+        lexer.escape = ""
+        for token in lexer:
+            negated = len(token) > 1 and token.startswith("-")
+            if negated:
+                token = token[1:]
+            field, sep, value = token.partition(":")
+            if sep and field in Query.fields:
+                if len(value) > 1 and value[0] == value[-1] == "/":
+                    value = re.compile(value[1:-1], re.I)
+                self.terms.append((negated, Query.fields[field], value))
+            else:
+                if len(token) > 1 and token[0] == token[-1] == "/":
+                    token = token[1:-1]
+                if negated:
+                    self.excluded.append(Filter([token]))
+                else:
+                    self.keywords.append(token)
+        self.filter = Filter(self.keywords)
+
+    def get_fields(self):
+        """Returns the set of the fields checked by the query or None
+        if it has keywords (which are checked on all the fields)."""
+        if self.keywords or self.excluded:
+            return None
+        return set(field for negated, field, value in self.terms)
+
+    def match_term(self, entry, field, value):
+        """Returns True if a field of the entry matches the value of a
+        term."""
+        values = entry.tags if field == "tags" else [getattr(entry, field)]
+        if isinstance(value, basestring):
+            return value in values
+        for v in values:
+            if value.search(v):
+                return True
+        return False
+
+    def match(self, entry, terms=None):
+        """Returns True if the entry matches the query. Only the given
+        field terms are checked (all of them by default) but the
+        keywords are always checked."""
+        for negated, field, value in (self.terms if terms is None
+                                      else terms):
+            if self.match_term(entry, field, value) == negated:
+                return False
+        for f in self.excluded:
+            if f.match(entry):
+                return False
+        return self.filter.match(entry)
+
+tag_token_re = re.compile(r"\\(.)|(.)", re.S)
+
+def parse_tag_expression(expression):
+    """Returns the alternatives of a tag expression (see
+    PasswordManager.get_expression_bits) as lists of (negated, tag)
+    tuples. A backslash escapes the next character, so that a tag may
+    contain a comma, a | or a leading ! or space (e.g. "a\\,b" is
+    the tag "a,b")."""
+    alternatives = []
+    terms = []
+    chars = []
+    negated = False
+    for escaped, c in tag_token_re.findall(expression):
+        if not escaped and c in ",|":
+            terms.append((negated, get_tag_name(chars)))
+            chars = []
+            negated = False
+            if c == "|":
+                alternatives.append(terms)
+                terms = []
+        elif not escaped and c == "!" and not negated and \
+                 not get_tag_name(chars):
+            negated = True
+            chars = []
+        else:
+            chars.append((escaped or c, bool(escaped)))
+    terms.append((negated, get_tag_name(chars)))
+    alternatives.append(terms)
+    return alternatives
+
+def get_tag_name(chars):
+    """Returns the tag of a list of (character, escaped) tuples
+    without its leading and trailing (unescaped) spaces."""
+    start, end = 0, len(chars)
+    while start < end and chars[start][0].isspace() and \
+          not chars[start][1]:
+        start += 1
+    while end > start and chars[end - 1][0].isspace() and \
+          not chars[end - 1][1]:
+        end -= 1
+    return "".join(c for c, escaped in chars[start:end])
+
+def get_bytes_bits(array):
+    """Returns the bitset (a long) of a bytearray whose byte i holds
+    the bits 8i to 8i+7. The bytearray is reversed in place."""
+    if not array:
+        return 0
+    array.reverse()
+    return long(binascii.hexlify(array), 16)
+
+def get_bits(indexes, n):
+    """Returns a bitset (a long) of size n where the bits of the given
+    indexes are set."""
+    array = bytearray((n + 7) // 8)
+    for i in indexes:
+        array[i >> 3] |= 1 << (i & 7)
+    return get_bytes_bits(array)
+
+bool_digits = string.maketrans("\x00\x01", "01")
+
+def get_bools_bits(bools):
+    """Returns the bitset (a long) whose bit i is set if bools[i] is
+    true."""
+    return long(str(bytearray(bools)).translate(bool_digits)[::-1] or "0",
+                2)
+
+def get_bit_indexes(bits):
+    """Yields the index of each bit set in a bitset, in increasing
+    order."""
+    bits = bin(bits)[:1:-1]
+    i = bits.find("1")
+    while i >= 0:
+        yield i
+        i = bits.find("1", i + 1)
+
+def get_fuzzy_line(entry):
+    """Returns the line of an entry in a FuzzyIndex: its name and
+    username in lowercase, separated by a space."""
+    line = entry.name + " " + entry.username
+    return get_fuzzy_text(line.replace("\n", " "))
+
+def get_fuzzy_text(s):
+    """Returns a string in lowercase, decoded from UTF-8 (as an unicode
+    string) unless it is ASCII so that it can be compared with the
+    lines of a FuzzyIndex."""
+    if isinstance(s, str):
+        try:
+            s.decode("ascii")
+        except UnicodeDecodeError:
+            s = s.decode("utf-8", "replace")
+    return s.lower()
+
+# Queries of at most SHORT_QUERY characters are found in most of the
+# lines: when they don't start enough lines, only these lines and the
+# first SHORT_QUERY_CANDIDATES lines containing their characters are
+# ranked.
+SHORT_QUERY = 2
+SHORT_QUERY_CANDIDATES = 4096
+
+class FuzzyIndex:
+    """A FuzzyIndex is used to rank the entries whose name and
+    username (lowercase, separated by a space) contain the characters
+    of a query in order. An entry is scored by the span of the
+    leftmost match (the shortest the better, so that substrings come
+    first), then its start position and the length of the line.
+
+    The lines are identified by the slots of their entries (see
+    PasswordManager) and lines[i] is None for a free slot. The masks
+    (a long per character whose bit i is set if line i contains the
+    character) restrict the matching to the lines containing all the
+    characters of the query. The lines starting with the query are
+    the best matches: they are found in the sorted list of the (line,
+    slot) tuples without scanning the other lines."""
+
+    def __init__(self, entries):
+        """Builds the index of a list of entries (whose slots are
+        their positions)."""
+        self.lines = [get_fuzzy_line(e) for e in entries]
+        self.sorted_lines = sorted(zip(self.lines, xrange(len(entries))))
+        # Testing each line for each character is faster than building
+        # the set of the characters of each line.
+        self.masks = {}
+        n = len(self.lines)
+        for c in set("".join(self.lines)):
+            self.masks[c] = get_bools_bits(map(operator.contains, self.lines,
+                                               itertools.repeat(c, n)))
+
+    def add(self, entry, slot):
+        """Adds the line of an entry with the given (free) slot."""
+        line = get_fuzzy_line(entry)
+        if slot >= len(self.lines):
+            self.lines.extend([None] * (slot + 1 - len(self.lines)))
+        self.lines[slot] = line
+        bisect.insort(self.sorted_lines, (line, slot))
+        bit = 1 << slot
+        for c in set(line):
+            self.masks[c] = self.masks.get(c, 0) | bit
+
+    def remove(self, slot):
+        """Removes the line of a slot."""
+        line = self.lines[slot]
+        self.lines[slot] = None
+        del self.sorted_lines[bisect.bisect_left(self.sorted_lines,
+                                                 (line, slot))]
+        bit = ~(1 << slot)
+        for c in set(line):
+            self.masks[c] &= bit
+
+    def get_prefixed(self, query):
+        """Returns the sorted list of the (line, slot) tuples of the
+        lines starting with the query."""
+        # These lines are lower than the query whose last character is
+        # replaced with the next one.
+        start = bisect.bisect_left(self.sorted_lines, (query,))
+        end = bisect.bisect_left(self.sorted_lines,
+                                 (query[:-1] + unichr(ord(query[-1]) + 1),),
+                                 start)
+        return self.sorted_lines[start:end]
+
+    def get_candidates(self, query):
+        """Yields the slot of each line containing all the characters
+        of the query (according to the masks)."""
+        mask = -1
+        for c in set(query):
+            if c not in self.masks:
+                return
+            mask &= self.masks[c]
+        for i in get_bit_indexes(mask):
+            yield i
+
+    def get_matches(self, query, candidates):
+        """Yields a (span, start, length, slot) tuple for each line
+        (among the slots of the candidates) matching the query."""
+        regex = re.compile(re.escape(query[0]) +
+                           "".join("[^{0}]*{0}".format(re.escape(c))
+                                   for c in query[1:]))
+        for i in candidates:
+            m = regex.search(self.lines[i])
+            if m:
+                yield (m.end() - m.start(), m.start(), len(self.lines[i]), i)
+
+    def find(self, query, limit=10):
+        """Returns the slots of the limit best lines matching the query
+        (spaces are ignored), best match first."""
+        query = "".join(get_fuzzy_text(query).split())
+        if not query:
+            return []
+        # The lines starting with the query have the best span and
+        # start: if there are enough of them, the other lines can't be
+        # among the best ones.
+        prefixed = self.get_prefixed(query)
+        if prefixed and len(prefixed) >= limit:
+            lines, slots = zip(*prefixed)
+            return [m[1] for m in heapq.nsmallest(limit,
+                                                  zip(map(len, lines), slots))]
+        candidates = self.get_candidates(query)
+        if len(query) <= SHORT_QUERY:
+            candidates = set(itertools.islice(candidates,
+                                              SHORT_QUERY_CANDIDATES))
+            candidates.update(slot for line, slot in prefixed)
+        matches = self.get_matches(query, candidates)
+        return [m[3] for m in heapq.nsmallest(limit, matches)]
+
 class PasswordManager(yaml.YAMLObject):
     """A PasswordManager maintains lists of PasswordEntry objects that
-    can be grouped with tags."""
+    can be grouped with tags. An index of the entries' names and an
+    inverted index of the tags are kept up to date by the manager's
+    methods. The list of entries must be replaced with set_entries,
+    entries must not be modified once they have been added (they must
+    be replaced with set_entry) and their tags must be modified with
+    the manager.
+
+    Each entry has a slot (an integer) which doesn't change when the
+    entries before it are removed: slots[i] is the slot of the entry
+    at position i (slots are increasing) and slot_entries the entry
+    of each slot (None for a free slot). The names are mapped to
+    slots. Tags are interned to small integers (ids) and each tag is
+    mapped to a bitset (a long) whose bit i is set if the entry of
+    slot i has the tag, live_bits being the bitset of the used slots.
+    The trigram index maps each trigram to an array of slots and the
+    fuzzy index identifies the lines of the entries by slot. The
+    slots are numbered again (and the indexes rebuilt) once most of
+    them are free.
+
+    Once start_journal has been called, the changes made by the
+    manager's methods are recorded in its journal (see replay) so
+    that they can be saved without saving all the entries."""
     yaml_tag = u'!PasswordManager'
 
     def __init__(self, directory):
         """Initializes an empty manager."""
         self.passwords = []
-        self.tags = set()
+        self.slots = []
+        self.slot_entries = []
+        self.names = {}
+        self.duplicate_names = set()
+        self.live_bits = 0
+        self.tag_ids = {}
+        self.tag_names = []
+        self.tag_bits = []
+        self.trigrams = {}
+        self.stale_trigrams = 0
+        self.fuzzy_index = FuzzyIndex([])
+        self.journal = None
         self.generator_manager = passgen.GeneratorManager(directory)
 
+    def set_entries(self, entries):
+        """Replaces all the entries of the manager (e.g. with the
+        entries loaded from a database) and rebuilds the indexes. The
+        journal is stopped as it can't record this change."""
+        self.passwords = entries
+        self.compute_indexes()
+        self.journal = None
+
+    def start_journal(self):
+        """Starts recording the changes in an empty journal. A change
+        is a tuple ("set", entry) for set_entry, ("remove", positions)
+        for the removal of the entries at the given positions,
+        ("tags", position, tags) for the modification of the tags of
+        the entry at the given position and ("fingerprint", position,
+        fingerprint) for the fingerprint recorded for the entry at the
+        given position (see record_fingerprints)."""
+        self.journal = []
+
+    def log(self, *change):
+        """Records a change in the journal if it has been started."""
+        if self.journal is not None:
+            self.journal.append(change)
+
+    def replay(self, changes):
+        """Applies changes recorded in a journal (without recording
+        them again)."""
+        journal, self.journal = self.journal, None
+        try:
+            for change in changes:
+                if change[0] == "set":
+                    self.set_entry(change[1])
+                elif change[0] == "remove":
+                    self.remove_entries([self.passwords[i]
+                                         for i in change[1]])
+                elif change[0] == "tags":
+                    self.set_entry_tags(self.passwords[change[1]],
+                                        change[2])
+                elif change[0] == "fingerprint":
+                    self.passwords[change[1]].fingerprint = change[2]
+                else:
+                    raise ValueError("Unknown change: {}".format(change[0]))
+        finally:
+            self.journal = journal
+
+    def compute_indexes(self):
+        """Numbers the slots of the entries again (the slot of each
+        entry is its position) and rebuilds all the indexes."""
+        self.slots = range(len(self.passwords))
+        self.slot_entries = list(self.passwords)
+        self.compute_names()
+        self.compute_tags()
+        self.compute_trigrams()
+        self.fuzzy_index = FuzzyIndex(self.passwords)
+
+    def compact_indexes(self):
+        """Numbers the slots again if most of them are free, or
+        rebuilds the trigram index if it has as many stale entries
+        (see unindex_trigrams) as entries."""
+        n = len(self.passwords) + 1024
+        if len(self.slot_entries) > len(self.passwords) + n:
+            self.compute_indexes()
+        elif self.stale_trigrams > n:
+            self.compute_trigrams()
+
+    def compute_names(self):
+        """Rebuilds the index of the names of the entries. Each name is
+        associated with the slot of the first entry having it. The
+        names of several entries are also kept in duplicate_names."""
+        self.names = {}
+        self.duplicate_names = set()
+        for slot, e in zip(self.slots, self.passwords):
+            if self.names.setdefault(e.name, slot) != slot:
+                self.duplicate_names.add(e.name)
+
     def compute_tags(self):
-        """Find the tags used associated with at least one entry."""
-        self.tags.clear()
-        for p in self.passwords:
-            for t in p.tags:
-                self.tags.add(t)
+        """Rebuilds the inverted index of the tags: the tags of the
+        entries are interned again and the bitset of each tag is
+        built in a single pass over the entries."""
+        self.live_bits = get_bits(self.slots, len(self.slot_entries))
+        size = (len(self.slot_entries) + 7) // 8
+        arrays = {}
+        for i, e in zip(self.slots, self.passwords):
+            byte, bit = i >> 3, 1 << (i & 7)
+            for t in e.tags:
+                array = arrays.get(t)
+                if array is None:
+                    array = arrays[t] = bytearray(size)
+                array[byte] |= bit
+        self.tag_ids = {}
+        self.tag_names = []
+        self.tag_bits = []
+        for t, array in arrays.iteritems():
+            self.tag_bits[self.get_tag_id(t)] = get_bytes_bits(array)
+
+    def get_tag_id(self, tag):
+        """Returns the id of a tag, interning it if needed."""
+        if tag not in self.tag_ids:
+            self.tag_ids[tag] = len(self.tag_names)
+            self.tag_names.append(tag)
+            self.tag_bits.append(0)
+        return self.tag_ids[tag]
+
+    def get_position(self, entry):
+        """Returns the position of an entry. Raises a ValueError if the
+        entry is not in the manager."""
+        slot = self.names.get(entry.name)
+        if slot is None or self.slot_entries[slot] is not entry:
+            return self.passwords.index(entry)
+        return bisect.bisect_left(self.slots, slot)
+
+    def index_tags(self, entry, slot, tags=None):
+        """Sets the bit of the slot of the entry in the bitsets of its
+        tags (or only of the given tags)."""
+        bit = 1 << slot
+        for t in (entry.tags if tags is None else tags):
+            self.tag_bits[self.get_tag_id(t)] |= bit
+
+    def unindex_tags(self, entry, slot, tags=None):
+        """Clears the bit of the slot of the entry in the bitsets of
+        its tags (or only of the given tags)."""
+        bit = ~(1 << slot)
+        for t in (entry.tags if tags is None else tags):
+            if t in self.tag_ids:
+                self.tag_bits[self.tag_ids[t]] &= bit
+
+    def get_tag_bits(self, tag):
+        """Returns the bitset of the entries having a tag."""
+        if tag in self.tag_ids:
+            return self.tag_bits[self.tag_ids[tag]]
+        return 0
+
+    def get_expression_bits(self, expression):
+        """Returns the bitset of the entries matching a tag expression.
+        Tags separated by commas must all be present and a tag
+        preceded by ! must be absent. Such lists of tags can be
+        separated by | to get the entries matching one of them (e.g.
+        "work,!archived|personal"). These characters are escaped with
+        a backslash in the name of a tag (see parse_tag_expression)."""
+        result = 0
+        for terms in parse_tag_expression(expression):
+            bits = self.live_bits
+            for negated, tag in terms:
+                if negated:
+                    bits &= ~self.get_tag_bits(tag)
+                else:
+                    bits &= self.get_tag_bits(tag)
+            result |= bits
+        return result
+
+    def get_bits_entries(self, bits):
+        """Returns the list of the entries of a bitset of slots (in the
+        order of their positions)."""
+        return [self.slot_entries[i] for i in get_bit_indexes(bits)]
+
+    def compute_trigrams(self):
+        """Rebuilds the trigram index: each (lowercase) trigram of the
+        name, username, nonce, comment or tags of an entry is mapped
+        to an array of the slots of these entries (a slot may appear
+        several times). The trigrams of the values shared by several
+        entries (e.g. usernames or tags) are only computed once."""
+        postings = {}
+        values = {}
+        for slot, e in zip(self.slots, self.passwords):
+            for t in get_trigrams(e.name):
+                slots = postings.get(t)
+                if slots is None:
+                    postings[t] = [slot]
+                else:
+                    slots.append(slot)
+            for v in [e.username, e.nonce, e.comment]:
+                if v:
+                    values.setdefault(v, []).append(slot)
+            for v in e.tags:
+                values.setdefault(v, []).append(slot)
+        for v, value_slots in values.iteritems():
+            for t in get_trigrams(v):
+                postings.setdefault(t, []).extend(value_slots)
+        self.trigrams = dict((t, array.array('I', slots))
+                             for t, slots in postings.iteritems())
+        self.stale_trigrams = 0
+
+    def index_trigrams(self, entry, slot):
+        """Adds the slot of an entry to the trigram index."""
+        for t in get_entry_trigrams(entry):
+            slots = self.trigrams.get(t)
+            if slots is None:
+                self.trigrams[t] = array.array('I', [slot])
+            else:
+                slots.append(slot)
+
+    def unindex_trigrams(self):
+        """Records that the slot of an entry which is removed or
+        modified is stale in the trigram index. It is left in the
+        arrays of the entry's trigrams (it only adds candidates to
+        check) until the index is rebuilt (see compact_indexes)."""
+        self.stale_trigrams += 1
 
     def get_entries(self, tag=None):
         """Returns the list of PasswordEntries. It is possible to
-        specify a tag to get only the entries associated with this
-        tag."""
+        specify a tag (or a tag expression, see get_expression_bits)
+        to get only the entries associated with this tag."""
         if tag:
-            return [e for e in self.passwords if tag in e.tags]
+            return self.get_bits_entries(self.get_expression_bits(tag))
         else:
             return self.passwords
 
     def get_entry(self, name):
         """Returns an entry which the name match."""
-        for e in self.passwords:
-            if e.name == name:
-                return e
+        if name in self.names:
+            return self.slot_entries[self.names[name]]
 
     def set_entry(self, entry):
-        """Adds a PasswordEntry."""
-        for i, e in enumerate(self.passwords):
-            if e.name == entry.name:
-                self.passwords[i] = entry
-                return
-        self.passwords.append(entry)
+        """Adds a PasswordEntry. It replaces the entry with the same
+        name if any."""
+        if entry.name in self.names:
+            slot = self.names[entry.name]
+            i = bisect.bisect_left(self.slots, slot)
+            self.unindex_tags(self.passwords[i], slot)
+            self.unindex_trigrams()
+            self.fuzzy_index.remove(slot)
+            self.passwords[i] = entry
+        else:
+            slot = len(self.slot_entries)
+            self.names[entry.name] = slot
+            self.passwords.append(entry)
+            self.slots.append(slot)
+            self.slot_entries.append(None)
+            self.live_bits |= 1 << slot
+        self.slot_entries[slot] = entry
+        self.index_tags(entry, slot)
+        self.index_trigrams(entry, slot)
+        self.fuzzy_index.add(entry, slot)
+        self.log("set", entry)
+        self.compact_indexes()
 
     def remove_entry(self, entry):
-        """Removes a PasswordEntry."""
-        self.passwords.remove(entry)
-        self.compute_tags()
+        """Removes a PasswordEntry. Raises a ValueError if the entry is
+        not in the manager."""
+        i = self.get_position(entry)
+        # The stored entry may be another object equal to entry.
+        stored = self.passwords[i]
+        slot = self.slots[i]
+        del self.passwords[i]
+        del self.slots[i]
+        self.slot_entries[slot] = None
+        self.live_bits &= ~(1 << slot)
+        # The removed name may still be used by a later entry.
+        if self.names.get(stored.name) == slot:
+            del self.names[stored.name]
+            if stored.name in self.duplicate_names:
+                for j in xrange(i, len(self.passwords)):
+                    if self.passwords[j].name == stored.name:
+                        self.names[stored.name] = self.slots[j]
+                        break
+        self.unindex_tags(stored, slot)
+        self.unindex_trigrams()
+        self.fuzzy_index.remove(slot)
+        self.log("remove", [i])
+        self.compact_indexes()
+
+    def remove_entries(self, entries):
+        """Removes several PasswordEntries at once and returns the list
+        of the removed entries. entries is either a function returning
+        True for each entry to remove or a collection of entries
+        (compared by identity). The list of entries is rebuilt in a
+        single pass and the indexes are updated once."""
+        if callable(entries):
+            predicate = entries
+        else:
+            ids = set(id(e) for e in entries)
+            predicate = lambda e: id(e) in ids
+        kept = []
+        kept_slots = []
+        removed = []
+        positions = []
+        for i, e in enumerate(self.passwords):
+            if predicate(e):
+                removed.append(e)
+                positions.append(i)
+            else:
+                kept.append(e)
+                kept_slots.append(self.slots[i])
+        if removed:
+            self.log("remove", positions)
+            # Cheaper to rebuild all the indexes if most entries are
+            # removed.
+            rebuild = len(removed) > len(kept)
+            for i, e in zip(positions, removed):
+                slot = self.slots[i]
+                self.slot_entries[slot] = None
+                self.live_bits &= ~(1 << slot)
+                self.unindex_tags(e, slot)
+                self.unindex_trigrams()
+                self.fuzzy_index.remove(slot)
+            self.passwords[:] = kept
+            self.slots = kept_slots
+            if rebuild:
+                self.compute_indexes()
+            else:
+                self.compute_names()
+                self.compact_indexes()
+        return removed
 
     def add_tag(self, entry, tag):
         """Adds a tag to an entry."""
-        entry.tags.add(tag)
-        self.compute_tags()
+        i = self.get_position(entry)
+        self.unindex_trigrams()
+        entry.tags = entry.tags.union([tag])
+        self.index_tags(entry, self.slots[i], [tag])
+        self.index_trigrams(entry, self.slots[i])
+        self.log("tags", i, entry.tags)
+        self.compact_indexes()
 
     def remove_tag(self, entry, tag):
-        """Removes a tag from an entry."""
-        entry.tags.remove(tag)
-        self.compute_tags()
+        """Removes a tag from an entry. Raises a KeyError if the entry
+        doesn't have the tag."""
+        if tag not in entry.tags:
+            raise KeyError(tag)
+        i = self.get_position(entry)
+        self.unindex_trigrams()
+        entry.tags = entry.tags.difference([tag])
+        self.unindex_tags(entry, self.slots[i], [tag])
+        self.index_trigrams(entry, self.slots[i])
+        self.log("tags", i, entry.tags)
+        self.compact_indexes()
 
     def set_entry_tags(self, entry, tags):
         """Modifies the tags of an entry."""
-        entry.tags = set(tags)
-        self.compute_tags()
+        i = self.get_position(entry)
+        self.unindex_tags(entry, self.slots[i])
+        self.unindex_trigrams()
+        entry.tags = tags
+        self.index_tags(entry, self.slots[i])
+        self.index_trigrams(entry, self.slots[i])
+        self.log("tags", i, entry.tags)
+        self.compact_indexes()
 
     def get_tags(self):
         """Returns the list of all the tags."""
-        return list(self.tags)
+        return [t for t, bits in zip(self.tag_names, self.tag_bits) if bits]
+
+    def get_tag_counts(self):
+        """Returns a dict associating each tag with its number of
+        entries."""
+        return dict((t, bin(bits).count("1"))
+                    for t, bits in zip(self.tag_names, self.tag_bits) if bits)
+
+    def derive_all(self, passphrase, entries=None):
+        """Yields a (PasswordEntry, password) tuple for each entry of
+        the list entries (all the entries by default) using the master
+        passphrase. Each generator is resolved and prepared for the
+        passphrase only once for the whole list and results are
+        yielded in the order of the entries."""
+        if entries is None:
+            entries = self.passwords
+        generators = {}
+        for e in entries:
+            if e.generator not in generators:
+                generator = self.generator_manager.get_generator(e.generator)
+                generators[e.generator] = (generator,
+                                           generator.prepare(passphrase))
+            generator, derive = generators[e.generator]
+            yield e, e.derive_password(generator, derive)
+
+    def check_fingerprints(self):
+        """Returns the list of entries for which the generator's
+        fingerprint has changed (or the generator can't be loaded
+        anymore) since it has been recorded. No password is
+        generated."""
+        changed = []
+        generators = {}
+        for e in self.passwords:
+            if not e.fingerprint:
+                continue
+            generator = self.find_generator(e.generator, generators)
+            if not generator or not e.check_fingerprint(generator):
+                changed.append(e)
+        return changed
+
+    def record_fingerprints(self):
+        """Records the fingerprint of the generator of the entries
+        which don't have one yet (they are skipped if their generator
+        can't be loaded), so that check_fingerprints can detect a
+        later change. Returns the list of these entries. No password
+        is generated."""
+        recorded = []
+        generators = {}
+        for i, e in enumerate(self.passwords):
+            if e.fingerprint:
+                continue
+            generator = self.find_generator(e.generator, generators)
+            if generator:
+                e.fingerprint = generator.fingerprint
+                self.log("fingerprint", i, e.fingerprint)
+                recorded.append(e)
+        return recorded
+
+    def find_generator(self, name, generators):
+        """Returns the generator with the given name, or None if it
+        can't be loaded. generators is a dict caching the results."""
+        if name not in generators:
+            try:
+                generators[name] = self.generator_manager.get_generator(name)
+            except (IOError, OSError, ValueError):
+                generators[name] = None
+        return generators[name]
 
     def filter(self, keywords):
         """Returns a subset of the entries where the name, username,
         nonce or tags matches all the keywords (list of regular
-        expressions)."""
-        return [e for e in self.passwords if e.match(keywords)]
+        expressions). The keywords are compiled only once. If some
+        keywords are plain strings of at least 3 characters, only the
+        entries having all their trigrams (according to the trigram
+        index) are checked, otherwise all the entries are."""
+        match = Filter(keywords).match
+        candidates = self.get_candidates(keywords)
+        if candidates is None:
+            return [e for e in self.passwords if match(e)]
+        candidates = sorted(candidates, key=lambda e: self.names.get(e.name))
+        return [e for e in candidates if match(e)]
+
+    def get_indexed_entries(self, field, value):
+        """Returns the set of the entries matching a query term using
+        the name or the tag index, or None if the term can't be
+        answered with an index."""
+        if field == "name" and isinstance(value, basestring):
+            slot = self.names.get(value)
+            return set() if slot is None else set([self.slot_entries[slot]])
+        elif field == "tags":
+            if isinstance(value, basestring):
+                bits = self.get_tag_bits(value)
+            else:
+                bits = 0
+                for t, i in self.tag_ids.iteritems():
+                    if value.search(t):
+                        bits |= self.tag_bits[i]
+            return set(self.get_bits_entries(bits))
+
+    def query(self, query):
+        """Returns the entries matching a query (a string or a Query
+        object). The positive name and tag terms are answered with the
+        indexes and plain keywords with the trigram index (see
+        get_candidates); the other terms are only checked on the
+        remaining entries (or on all the entries if there is no such
+        term)."""
+        if isinstance(query, basestring):
+            query = Query(query)
+        candidates = None
+        terms = []
+        for term in query.terms:
+            negated, field, value = term
+            entries = None if negated else \
+                      self.get_indexed_entries(field, value)
+            if entries is None:
+                terms.append(term)
+            elif candidates is None:
+                candidates = entries
+            else:
+                candidates &= entries
+        if candidates is None and query.keywords:
+            candidates = self.get_candidates(query.keywords)
+        if candidates is None:
+            return [e for e in self.passwords if query.match(e, terms)]
+        candidates = sorted(candidates, key=lambda e: self.names.get(e.name))
+        return [e for e in candidates if query.match(e, terms)]
+
+    def fuzzy_find(self, query, limit=10):
+        """Returns the (at most limit) entries whose name and username
+        contain the characters of the query in order, best match first
+        (see FuzzyIndex)."""
+        return [self.slot_entries[i]
+                for i in self.fuzzy_index.find(query, limit)]
+
+    def get_candidates(self, keywords):
+        """Returns the set of the entries which may match the plain
+        keywords according to the trigram index or None if none of the
+        keywords is a plain ASCII string of at least 3 characters."""
+        trigrams = set()
+        for k in keywords:
+            if plain_keyword.match(k) and all(ord(c) < 128 for c in k):
+                trigrams.update(get_trigrams(k))
+        if not trigrams:
+            return None
+        postings = []
+        for t in trigrams:
+            if t not in self.trigrams:
+                return set()
+            postings.append(self.trigrams[t])
+        postings.sort(key=len)
+        slots = set(postings[0])
+        for p in postings[1:]:
+            if not slots:
+                break
+            slots.intersection_update(p)
+        entries = set(self.slot_entries[s] for s in slots)
+        entries.discard(None)
+        return entries
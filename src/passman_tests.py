@@ -18,14 +18,23 @@
 import unittest
 import os
 import copy
+import pickle
+import yaml
+import passman
 
 from passgen import GeneratorManager
-from passman import PasswordEntry, PasswordManager
+from passman import PasswordEntry, PasswordManager, Query, get_bits, \
+    get_bools_bits, interned_tags, parse_tag_expression
 
 def generate_default_symbols(filename):
     with open(filename, 'w') as f:
         f.write("\n".join([chr(33 + i) for i in xrange(94)]))
 
+def remove_symbols(filename):
+    os.remove(filename)
+    if os.path.exists(filename + ".sym"):
+        os.remove(filename + ".sym")
+
 class TestPasswordEntry(unittest.TestCase):
     def setUp(self):
         generate_default_symbols("test_symbols")
@@ -34,7 +43,7 @@ class TestPasswordEntry(unittest.TestCase):
                                    "Comment about password", "nonce", 16)
 
     def tearDown(self):
-        os.remove("test_symbols")
+        remove_symbols("test_symbols")
 
     def test_eq(self):
         entry2 = copy.copy(self.entry)
@@ -49,6 +58,59 @@ class TestPasswordEntry(unittest.TestCase):
         self.assertTrue(not self.entry.match(["nm", "abc"]))
         self.assertTrue(not self.entry.match(["nm", "site"]))
 
+    def test_match_fields(self):
+        self.assertTrue(self.entry.match(["^nonce$", "password$"]))
+        self.assertTrue(not self.entry.match(["name\\susername"]))
+        self.assertTrue(not self.entry.match(["name[^x]+username"]))
+        self.assertTrue(self.entry.match(["\\Ausername\\Z"]))
+        self.assertTrue(not self.entry.match(["(?<=e)username"]))
+
+    def test_search_blob(self):
+        blob = self.entry.get_search_blob()
+        self.assertEqual(blob, "name\nusername\nnonce\n"
+                         "Comment about password")
+        self.assertTrue(self.entry.get_search_blob() is blob)
+        self.entry.tags = set(["tag"])
+        self.assertTrue(self.entry.match(["^tag$"]))
+        self.entry.comment = "line1\nline2"
+        self.assertEqual(self.entry.get_search_blob(), None)
+        self.assertTrue(not self.entry.match(["^line2"]))
+        self.assertTrue("_search_blob" not in self.entry.__getstate__())
+
+    def test_serialize(self):
+        self.entry.tags = ["tag1", "tag2"]
+        s = yaml.dump([self.entry])
+        self.assertTrue("!!set" in s)
+        entry = yaml.load(s)[0]
+        self.assertEqual(entry, self.entry)
+        self.assertEqual(entry.tags, set(["tag1", "tag2"]))
+        entry = pickle.loads(pickle.dumps(self.entry, 2))
+        self.assertEqual(entry, self.entry)
+        self.assertEqual(entry.tags, self.entry.tags)
+
+    def test_load_defaults(self):
+        entry = yaml.load("!PasswordEntry {generator: sha512:test_symbols,"
+                          " name: name, username: username}")
+        self.assertEqual(entry.comment, "")
+        self.assertEqual(entry.nonce, "")
+        self.assertEqual(entry.length, 1)
+        self.assertEqual(entry.tags, set())
+        self.assertEqual(entry.fingerprint, None)
+
+    def test_interned(self):
+        entry = PasswordEntry("sha512:" + "test_symbols", "name2", "user",
+                              tags=["tag" + "1"])
+        self.entry.tags = set(["tag1"])
+        self.assertTrue(entry.generator is self.entry.generator)
+        self.assertTrue(entry.tags is self.entry.tags)
+        self.assertRaises(AttributeError, setattr, entry, "other", 1)
+
+    def test_interned_release(self):
+        self.entry.tags = ["released" + "1"]
+        self.assertTrue(frozenset(["released1"]) in interned_tags)
+        self.entry.tags = []
+        self.assertFalse(frozenset(["released1"]) in interned_tags)
+
 class TestPasswordManager(unittest.TestCase):
     def setUp(self):
         generate_default_symbols("test_symbols")
@@ -64,7 +126,7 @@ class TestPasswordManager(unittest.TestCase):
                                     "username3")
 
     def tearDown(self):
-        os.remove("test_symbols")
+        remove_symbols("test_symbols")
 
     def test_add_entry(self):
         self.manager.set_entry(self.entry1)
@@ -102,7 +164,80 @@ class TestPasswordManager(unittest.TestCase):
         self.manager.remove_entry(self.entry2)
         self.manager.remove_entry(self.entry3)
         self.assertEqual(len(self.manager.passwords), 0)
-        self.assertEqual(len(self.manager.tags), 0)
+        self.assertEqual(self.manager.get_tags(), [])
+
+    def test_names_index(self):
+        self.test_add_entry()
+        self.manager.remove_entry(self.entry2)
+        self.assertEqual(self.manager.get_entry("name1"), self.entry1)
+        self.assertEqual(self.manager.get_entry("name2"), None)
+        self.assertEqual(self.manager.get_entry("name3"), self.entry3)
+        self.manager.set_entry(self.entry2)
+        self.assertEqual(self.manager.get_entries(),
+                         [self.entry1, self.entry3, self.entry2])
+        self.assertEqual(self.manager.get_entry("name2"), self.entry2)
+        self.assertRaises(ValueError, self.manager.remove_entry,
+                          PasswordEntry("sha512:test_symbols", "name4",
+                                        "username4"))
+
+    def test_set_entries(self):
+        entry = copy.copy(self.entry1)
+        entry.username = "username4"
+        self.manager.set_entries([self.entry1, self.entry2, entry])
+        self.assertEqual(self.manager.get_entry("name1"), self.entry1)
+        self.manager.remove_entry(self.entry1)
+        self.assertEqual(self.manager.get_entry("name1"), entry)
+        self.assertEqual(self.manager.get_entry("name2"), self.entry2)
+
+    def test_remove_equal_entry(self):
+        self.test_add_entry()
+        self.manager.filter(["name"])
+        self.manager.filter(["name"])
+        self.manager.remove_entry(copy.copy(self.entry2))
+        self.assertEqual(self.manager.filter(["name2"]), [])
+        self.assertEqual(self.manager.filter(["name"]),
+                         [self.entry1, self.entry3])
+
+    def test_remove_entries(self):
+        self.test_add_entry()
+        removed = self.manager.remove_entries(self.manager.get_entries("tag2"))
+        self.assertEqual(removed, [self.entry1, self.entry2])
+        self.assertEqual(self.manager.get_entries(), [self.entry3])
+        self.assertEqual(self.manager.get_entry("name1"), None)
+        self.assertEqual(self.manager.get_entry("name3"), self.entry3)
+        self.assertItemsEqual(self.manager.get_tags(), ["tag3"])
+        removed = self.manager.remove_entries(lambda e: e.name == "name3")
+        self.assertEqual(removed, [self.entry3])
+        self.assertEqual(len(self.manager.passwords), 0)
+        self.assertEqual(self.manager.get_tags(), [])
+
+    def test_remove_all_entries(self):
+        self.test_add_entry()
+        self.manager.remove_entries(self.manager.get_entries())
+        self.assertEqual(self.manager.get_entries(), [])
+        self.assertEqual(self.manager.remove_entries([self.entry1]), [])
+
+    def test_journal(self):
+        self.manager.start_journal()
+        self.test_add_entry()
+        self.manager.add_tag(self.entry3, "tag1")
+        self.manager.remove_entry(self.entry2)
+        self.manager.remove_tag(self.entry1, "tag2")
+        self.manager.set_entry(self.entry2)
+        self.manager.remove_entries([self.entry1])
+        self.assertEqual(self.manager.journal[:2],
+                         [("set", self.entry1),
+                          ("tags", 0, frozenset(["tag1", "tag2"]))])
+        self.assertEqual(self.manager.journal[-1], ("remove", [0]))
+        manager = PasswordManager(".")
+        manager.start_journal()
+        manager.replay(self.manager.journal)
+        self.assertEqual(manager.journal, [])
+        self.assertEqual(manager.get_entries(), [self.entry3, self.entry2])
+        self.assertEqual(manager.get_tag_counts(),
+                         self.manager.get_tag_counts())
+        self.manager.set_entries([])
+        self.assertEqual(self.manager.journal, None)
 
     def test_add_tag(self):
         self.test_add_entry()
@@ -115,6 +250,84 @@ class TestPasswordManager(unittest.TestCase):
         self.manager.remove_tag(self.entry1, "tag2")
         self.assertEqual([self.entry2], self.manager.get_entries("tag2"))
 
+    def test_tag_expressions(self):
+        self.test_add_entry()
+        get = self.manager.get_entries
+        self.assertEqual(get("tag2,!tag1"), [self.entry2])
+        self.assertEqual(get("tag1|tag3"), [self.entry1, self.entry3])
+        self.assertEqual(get("!tag2"), [self.entry3])
+        self.assertEqual(get("tag2, !tag1 | tag3"),
+                         [self.entry2, self.entry3])
+        self.assertEqual(get("unknown"), [])
+        self.assertEqual(get("!unknown"),
+                         [self.entry1, self.entry2, self.entry3])
+
+    def test_escaped_tag_expression(self):
+        self.test_add_entry()
+        self.manager.add_tag(self.entry3, "a,b")
+        self.manager.add_tag(self.entry2, "!x|y")
+        self.manager.add_tag(self.entry1, " a\\")
+        self.manager.add_tag(self.entry1, "a")
+        self.manager.add_tag(self.entry2, "b")
+        get = self.manager.get_entries
+        self.assertEqual(get("a,b"), [])
+        self.assertEqual(get("a|b"), [self.entry1, self.entry2])
+        self.assertEqual(get("a\\,b"), [self.entry3])
+        self.assertEqual(get("a\\,b|tag1"), [self.entry1, self.entry3])
+        self.assertEqual(get("\\!x\\|y"), [self.entry2])
+        self.assertEqual(get("!\\!x\\|y, tag2"), [self.entry1])
+        self.assertEqual(get("\\ a\\\\"), [self.entry1])
+
+    def test_parse_tag_expression(self):
+        self.assertEqual(parse_tag_expression(" a , !b|c"),
+                         [[(False, "a"), (True, "b")], [(False, "c")]])
+        self.assertEqual(parse_tag_expression("! a\\ |\\!b\\,c\\"),
+                         [[(True, "a ")], [(False, "!b,c\\")]])
+        self.assertEqual(parse_tag_expression(""), [[(False, "")]])
+
+    def test_get_bits(self):
+        self.assertEqual(get_bits([], 0), 0)
+        self.assertEqual(get_bits([0, 3, 9], 10), 521)
+        self.assertEqual(get_bits([16], 17), 1 << 16)
+        self.assertEqual(get_bools_bits([]), 0)
+        self.assertEqual(get_bools_bits([True, False, False, True]), 9)
+
+    def test_tag_bits(self):
+        self.test_add_entry()
+        self.manager.remove_entry(self.entry1)
+        # The bits are those of the slots of the entries
+        self.assertEqual(self.manager.get_tag_bits("tag2"), 2)
+        self.assertEqual(self.manager.get_tag_bits("tag3"), 4)
+        self.assertEqual(self.manager.get_tag_bits("tag1"), 0)
+        self.assertEqual(self.manager.live_bits, 6)
+        bits = self.manager.tag_bits
+        self.manager.compute_tags()
+        self.assertEqual(sorted(bits), sorted(self.manager.tag_bits + [0]))
+
+    def test_tag_counts(self):
+        self.test_add_entry()
+        self.assertEqual(self.manager.get_tag_counts(),
+                         {"tag1": 1, "tag2": 2, "tag3": 1})
+        self.manager.remove_tag(self.entry1, "tag1")
+        self.manager.add_tag(self.entry3, "tag2")
+        self.assertEqual(self.manager.get_tag_counts(),
+                         {"tag2": 3, "tag3": 1})
+        self.manager.remove_entry(self.entry2)
+        self.assertEqual(self.manager.get_tag_counts(),
+                         {"tag2": 2, "tag3": 1})
+        entry = copy.copy(self.entry3)
+        entry.tags = set(["tag4"])
+        self.manager.set_entry(entry)
+        self.assertEqual(self.manager.get_tag_counts(),
+                         {"tag2": 1, "tag4": 1})
+        self.assertEqual(self.manager.get_entries("tag4"), [entry])
+
+    def test_default_tags(self):
+        self.manager.set_entry(self.entry2)
+        self.manager.set_entry(self.entry3)
+        self.manager.add_tag(self.entry2, "tag1")
+        self.assertEqual(self.entry3.tags, set())
+
     def test_change_tags(self):
         self.test_add_entry()
         self.manager.set_entry_tags(self.entry1, ["tag1"])
@@ -137,5 +350,201 @@ class TestPasswordManager(unittest.TestCase):
                          [self.entry1])
         self.assertEqual(self.manager.filter(["^www.*co$"]), [])
 
+    def test_filter_modified_tags(self):
+        self.test_add_entry()
+        self.assertEqual(self.manager.filter(["^new$"]), [])
+        self.manager.add_tag(self.entry3, "new")
+        self.assertEqual(self.manager.filter(["^new$"]), [self.entry3])
+        self.manager.remove_tag(self.entry3, "new")
+        self.assertEqual(self.manager.filter(["^new$"]), [])
+
+    def test_filter_trigrams(self):
+        self.test_add_entry()
+        self.manager.add_tag(self.entry3, "site3")
+        self.manager.remove_tag(self.entry1, "tag2")
+        self.assertEqual(self.manager.stale_trigrams, 5)
+        self.assertEqual(self.manager.get_candidates(["tag2"]),
+                         set([self.entry1, self.entry2]))
+        self.manager.compute_trigrams()
+        self.assertEqual(self.manager.stale_trigrams, 0)
+        self.assertEqual(self.manager.get_candidates(["tag2"]),
+                         set([self.entry2]))
+        self.assertEqual(self.manager.get_candidates(["SITE"]),
+                         set([self.entry2, self.entry3]))
+        self.assertEqual(self.manager.get_candidates(["s.te"]), None)
+        self.assertEqual(self.manager.filter(["SITE", "name"]),
+                         [self.entry2, self.entry3])
+        self.assertEqual(self.manager.filter(["site2", "^www"]),
+                         [self.entry2])
+        self.assertEqual(self.manager.filter(["e1c"]), [])
+        self.manager.remove_entry(self.entry2)
+        self.assertEqual(self.manager.filter(["site"]), [self.entry3])
+
+    def test_build_trigrams(self):
+        self.manager.set_entries([self.entry1, self.entry2, self.entry3])
+        self.assertEqual(list(self.manager.trigrams["sit"]), [1])
+        self.assertEqual(self.manager.filter(["site"]), [self.entry2])
+        self.manager.remove_entry(self.entry1)
+        self.assertEqual(self.manager.slots, [1, 2])
+        self.assertEqual(list(self.manager.trigrams["sit"]), [1])
+        self.assertEqual(self.manager.filter(["site"]), [self.entry2])
+
+    def test_compact_slots(self):
+        entries = [PasswordEntry("sha512:test_symbols", "name{}".format(i),
+                                 "user") for i in xrange(1100)]
+        self.manager.set_entries(list(entries))
+        self.manager.remove_entries(entries[1:500])
+        self.assertEqual(len(self.manager.slot_entries), 1100)
+        self.manager.remove_entry(entries[0])
+        self.assertEqual(len(self.manager.slot_entries), 1100)
+        self.assertEqual(self.manager.filter(["name5"]),
+                         entries[500:600])
+        self.manager.remove_entries(entries[500:1050])
+        self.assertEqual(self.manager.slots, range(50))
+        self.assertEqual(self.manager.slot_entries, entries[1050:])
+        self.assertEqual(self.manager.filter(["name1099"]), [entries[-1]])
+
+    def test_fuzzy_find(self):
+        self.test_add_entry()
+        entry = PasswordEntry("sha512:test_symbols", "github.com", "alice")
+        self.manager.set_entry(entry)
+        self.assertEqual(self.manager.fuzzy_find("GitHub"), [entry])
+        self.assertEqual(self.manager.fuzzy_find("gthb al"), [entry])
+        self.assertEqual(self.manager.fuzzy_find("nme2"), [self.entry2])
+        self.assertEqual(self.manager.fuzzy_find("name"),
+                         [self.entry1, self.entry2, self.entry3])
+        self.assertEqual(self.manager.fuzzy_find("n3", 1), [self.entry3])
+        self.assertEqual(self.manager.fuzzy_find("nae", 2),
+                         [self.entry1, self.entry2])
+        self.assertEqual(self.manager.fuzzy_find("xyz"), [])
+        self.manager.remove_entry(entry)
+        self.assertEqual(self.manager.fuzzy_find("gthb"), [])
+        self.assertEqual(self.manager.fuzzy_index.masks["g"], 0)
+
+    def test_fuzzy_prefix(self):
+        entries = [PasswordEntry("sha512:test_symbols", name, "alice")
+                   for name in ["gitlab.com", "github.com", "agit.org",
+                                "gi.t", "git"]]
+        self.manager.set_entries(entries)
+        self.assertEqual(self.manager.fuzzy_index.get_prefixed("git"),
+                         [("git alice", 4), ("github.com alice", 1),
+                          ("gitlab.com alice", 0)])
+        self.assertEqual(self.manager.fuzzy_index.get_prefixed("gi"),
+                         [("gi.t alice", 3), ("git alice", 4),
+                          ("github.com alice", 1), ("gitlab.com alice", 0)])
+        # Found without matching the other lines
+        self.assertEqual(self.manager.fuzzy_find("git", 3),
+                         [entries[4], entries[0], entries[1]])
+        self.assertEqual(self.manager.fuzzy_find("git", 5),
+                         [entries[4], entries[0], entries[1], entries[2],
+                          entries[3]])
+        self.manager.remove_entry(entries[4])
+        entry = PasswordEntry("sha512:test_symbols", "Git", "bob")
+        self.manager.set_entry(entry)
+        self.assertEqual(self.manager.fuzzy_find("git", 2),
+                         [entry, entries[0]])
+        self.assertEqual(self.manager.fuzzy_index.get_prefixed("git"),
+                         [("git bob", 5), ("github.com alice", 1),
+                          ("gitlab.com alice", 0)])
+        entry = PasswordEntry("sha512:test_symbols", u"Gîte", "bob")
+        self.manager.set_entry(entry)
+        self.assertEqual(self.manager.fuzzy_find("gît", 1), [entry])
+
+    def test_fuzzy_short_query(self):
+        entries = [PasswordEntry("sha512:test_symbols", name, "alice")
+                   for name in ["axbx", "axb", "ab"]]
+        self.manager.set_entries(entries)
+        self.assertEqual(self.manager.fuzzy_find("b", 2),
+                         [entries[2], entries[1]])
+        candidates = passman.SHORT_QUERY_CANDIDATES
+        passman.SHORT_QUERY_CANDIDATES = 2
+        try:
+            # Only the lines of the first two slots are ranked...
+            self.assertEqual(self.manager.fuzzy_find("b", 2),
+                             [entries[1], entries[0]])
+            # ...and the lines starting with the query
+            self.assertEqual(self.manager.fuzzy_find("ab", 2),
+                             [entries[2], entries[1]])
+            self.assertEqual(self.manager.fuzzy_find("xbx", 2),
+                             [entries[0]])
+        finally:
+            passman.SHORT_QUERY_CANDIDATES = candidates
+
+    def test_query(self):
+        self.test_add_entry()
+        q = self.manager.query
+        self.assertEqual(q(""), [self.entry1, self.entry2, self.entry3])
+        self.assertEqual(q("tag:tag2"), [self.entry1, self.entry2])
+        self.assertEqual(q("tag:tag2 -tag:tag1"), [self.entry2])
+        self.assertEqual(q("tag:/TAG[13]/"), [self.entry1, self.entry3])
+        self.assertEqual(q("name:name2"), [self.entry2])
+        self.assertEqual(q("name:name"), [])
+        self.assertEqual(q("name:/^name[23]$/ -user:username3"),
+                         [self.entry2])
+        self.assertEqual(q("user:username1 tag:tag2"), [self.entry1])
+        self.assertEqual(q("comment:'Comment about password' -site"),
+                         [self.entry1])
+        self.assertEqual(q("/www.*com/"), [self.entry2])
+        self.assertEqual(q("tag:tag2 nonce"), [self.entry1])
+        self.assertEqual(q("http://www"), [])
+
+    def test_query_fields(self):
+        self.assertEqual(Query("tag:a -user:b").get_fields(),
+                         set(["tags", "username"]))
+        self.assertEqual(Query("").get_fields(), set())
+        self.assertEqual(Query("tag:a keyword").get_fields(), None)
+        self.assertEqual(Query("-keyword").get_fields(), None)
+
+    def test_check_fingerprints(self):
+        self.test_add_entry()
+        self.entry1.get_password(self.generator, "")
+        self.entry2.get_password(self.generator, "")
+        self.assertEqual(self.entry1.fingerprint,
+                         self.generator.get_generator(
+                             "sha512:test_symbols").fingerprint)
+        self.assertEqual(self.manager.check_fingerprints(), [])
+        with open("test_symbols", 'w') as f:
+            f.write("\n".join(["a", "b", "c"]))
+        # The generators are kept by the manager (e.g. for a command)
+        self.manager.generator_manager = GeneratorManager(".")
+        self.assertEqual(self.manager.check_fingerprints(),
+                         [self.entry1, self.entry2])
+
+    def test_record_fingerprints(self):
+        self.test_add_entry()
+        self.entry1.get_password(self.generator, "")
+        unknown = PasswordEntry("sha512:unknown_symbols", "name4", "user4")
+        self.manager.set_entry(unknown)
+        self.manager.start_journal()
+        self.assertEqual(self.manager.record_fingerprints(),
+                         [self.entry2, self.entry3])
+        fingerprint = self.generator.get_generator(
+            "sha512:test_symbols").fingerprint
+        self.assertEqual(self.entry3.fingerprint, fingerprint)
+        self.assertEqual(unknown.fingerprint, None)
+        self.assertEqual(self.manager.journal,
+                         [("fingerprint", 1, fingerprint),
+                          ("fingerprint", 2, fingerprint)])
+        self.assertEqual(self.manager.record_fingerprints(), [])
+        with open("test_symbols", 'w') as f:
+            f.write("\n".join(["a", "b", "c"]))
+        # The generators are kept by the manager (e.g. for a command)
+        self.manager.generator_manager = GeneratorManager(".")
+        self.assertEqual(self.manager.check_fingerprints(),
+                         [self.entry1, self.entry2, self.entry3])
+
+    def test_derive_all(self):
+        self.test_add_entry()
+        self.manager.set_entry(PasswordEntry("oplop", "name4", "username4"))
+        passwords = list(self.manager.derive_all("passphrase"))
+        self.assertEqual([e for e, p in passwords],
+                         self.manager.get_entries())
+        for e, p in passwords:
+            self.assertEqual(p, e.get_password(self.generator, "passphrase"))
+        passwords = list(self.manager.derive_all("passphrase",
+                                                 [self.entry2]))
+        self.assertEqual(len(passwords), 1)
+        self.assertEqual(passwords[0][0], self.entry2)
+
 if __name__ == '__main__':
     unittest.main()
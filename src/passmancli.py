@@ -64,14 +64,18 @@ class CLI:
 
         self.add_command(Create())
         self.add_command(List())
+        self.add_command(Tags())
         self.add_command(Add())
         self.add_command(Remove())
         self.add_command(AddTag())
         self.add_command(RemoveTag())
         self.add_command(Password())
+        self.add_command(Export())
         self.add_command(QuickPassword())
         self.add_command(Generate())
+        self.add_command(Calibrate())
         self.add_command(MakeDiceware())
+        self.add_command(Migrate())
 
     def add_command(self, command):
         """Adds a subparser to the general parser."""
@@ -158,17 +162,45 @@ class List(Command):
         Command.init(self, subparser)
         group = subparser.add_mutually_exclusive_group()
         group.add_argument("-t", "--tag",
-                           help="The tag of the entries to list.")
+                           help="The tag (or tag expression such as " + \
+                           "\"work,!archived|personal\") of the " + \
+                           "entries to list.")
         group.add_argument("-f", "--filter", nargs="+",
                            help="Regex used to filter the list to print.")
+        group.add_argument("-q", "--query",
+                           help="A query such as \"tag:work user:alice " + \
+                           "name:/git.*/ -tag:old\".")
+        group.add_argument("-z", "--fuzzy",
+                           help="Lists the best matches of a fuzzy query " + \
+                           "on the entries' name and username.")
         subparser.add_argument("-e", "--entropy",
                                action="store_true",
                                help="Computes the entries entropy.")
+        subparser.add_argument("-k", "--limit", type=int, default=10,
+                               help="The number of fuzzy matches to list.")
 
     def action(self):
-        actions.load_database(self.conf, self.loader)
+        actions.load_selection(self.conf, self.loader, self.args.tag,
+                               self.args.query, self.args.fuzzy,
+                               self.args.limit)
         actions.list_entries(self.conf, self.args.filter, self.args.tag,
-                             self.args.verbose, self.args.entropy)
+                             self.args.verbose, self.args.entropy,
+                             self.args.fuzzy, self.args.limit,
+                             self.args.query)
+
+
+class Tags(Command):
+    """Class used to represents the tags Command which lists the tags
+    of the database with their number of entries."""
+    name = "tags"
+    help = "Lists the tags of the database."
+
+    def init(self, subparser):
+        Command.init(self, subparser)
+
+    def action(self):
+        actions.load_database(self.conf, self.loader)
+        actions.list_tags(self.conf)
 
 
 class Add(Command):
@@ -209,13 +241,18 @@ class Remove(Command):
         Command.init(self, subparser)
         group = subparser.add_mutually_exclusive_group()
         group.add_argument("-t", "--tag",
-                           help="The tag of the entries to remove.")
+                           help="The tag (or tag expression) of the " + \
+                           "entries to remove.")
         group.add_argument("-f", "--filter", nargs="+",
                            help="Regex used to filter the list to print.")
+        group.add_argument("-q", "--query",
+                           help="A query such as \"tag:work user:alice " + \
+                           "name:/git.*/ -tag:old\".")
 
     def action(self):
         actions.load_database(self.conf, self.loader)
-        actions.remove(self.conf, self.args.filter, self.args.tag)
+        actions.remove(self.conf, self.args.filter, self.args.tag,
+                       self.args.query)
         actions.save_database(self.conf, self.loader)
 
 
@@ -275,9 +312,16 @@ class Password(Command):
         Command.init(self, subparser)
         group = subparser.add_mutually_exclusive_group()
         group.add_argument("-t", "--tag",
-                           help="The tag of the entries.")
+                           help="The tag (or tag expression) of the " + \
+                           "entries.")
         group.add_argument("-f", "--filter", nargs="+",
                            help="Regex used to filter the list of entries.")
+        group.add_argument("-q", "--query",
+                           help="A query such as \"tag:work user:alice " + \
+                           "name:/git.*/ -tag:old\".")
+        group.add_argument("-z", "--fuzzy",
+                           help="Fuzzy query on the entries' name and " + \
+                           "username, best match first.")
         subparser.add_argument("-i", "--index", type=int, default=0,
                                 help="The index of the entry in the " + \
                                 "tag/filtered list.")
@@ -286,10 +330,43 @@ class Password(Command):
                                 "instead of printing it to stdout.")
 
     def action(self):
-        actions.load_database(self.conf, self.loader)
+        actions.load_selection(self.conf, self.loader, self.args.tag,
+                               self.args.query, self.args.fuzzy,
+                               self.args.index + 1)
         actions.password(self.conf, self.args.filter, self.args.tag,
                          self.args.index, self.args.clipboard,
-                         self.args.verbose)
+                         self.args.verbose, self.args.fuzzy,
+                         self.args.query)
+
+
+class Export(Command):
+    """Class used to represents the export Command which derives the
+    passwords of the password entries associated with a tag or
+    filtered with regular expressions and writes them to a stream
+    using several processes."""
+
+    name = "export"
+    help = "Exports the passwords of the matching entries."
+
+    def init(self, subparser):
+        Command.init(self, subparser)
+        group = subparser.add_mutually_exclusive_group()
+        group.add_argument("-t", "--tag",
+                           help="The tag (or tag expression) of the " + \
+                           "entries.")
+        group.add_argument("-f", "--filter", nargs="+",
+                           help="Regex used to filter the list of entries.")
+        subparser.add_argument("-o", "--output", default=None,
+                               help="The output file name (default is " + \
+                               "stdout).")
+        subparser.add_argument("-j", "--processes", type=int, default=None,
+                               help="The number of worker processes " + \
+                               "(default is the number of CPUs).")
+
+    def action(self):
+        actions.load_selection(self.conf, self.loader, self.args.tag)
+        actions.export(self.conf, self.args.filter, self.args.tag,
+                       self.args.output, self.args.processes)
 
 
 class QuickPassword(Command):
@@ -344,16 +421,44 @@ class Generate(Command):
                                 help="The minimum password's entropy.")
         subparser.add_argument("-n", type=int, default=1,
                                 help="The number of passwords to generate.")
+        subparser.add_argument("--numpy", action="store_true",
+                                help="Use NumPy (if available) to " + \
+                                "generate many passwords at once.")
         subparser.add_argument("--clipboard", action="store_true",
                                 help="Copy password to system clipboard " + \
                                 "instead of printing it to stdout.")
 
     def action(self):
-        actions.load_database(self.conf, self.loader)
-        for i in xrange(self.args.n):
-            actions.generate(self.conf, self.args.generator,
-                             self.args.length, self.args.entropy,
-                             self.args.clipboard, self.args.verbose)
+        actions.generate(self.conf, self.args.generator,
+                         self.args.length, self.args.entropy,
+                         self.args.clipboard, self.args.verbose,
+                         self.args.n, self.args.numpy)
+
+
+class Calibrate(Command):
+    """Class used to represents the calibrate Command which benchmarks
+    this machine to choose the parameters of a key-stretching (PBKDF2)
+    generator."""
+
+    name = "calibrate"
+    help = "Chooses the parameters of a PBKDF2 generator for a " + \
+           "target derivation time."
+
+    def init(self, subparser):
+        Command.init(self, subparser)
+        subparser.add_argument("-t", "--time", type=int, default=100,
+                               help="The target derivation time in " + \
+                               "milliseconds (default is 100).")
+        subparser.add_argument("--hash", default="sha512",
+                               help="The hash algorithm (default is " + \
+                               "sha512).")
+        subparser.add_argument("-s", "--symbols", default=None,
+                               help="The symbols file name (see " + \
+                               "configuration file for default).")
+
+    def action(self):
+        actions.calibrate(self.conf, self.args.time, self.args.hash,
+                          self.args.symbols, self.args.verbose)
 
 
 class MakeDiceware(Command):
@@ -379,6 +484,29 @@ class MakeDiceware(Command):
                               self.args.min_length, self.args.out_filename)
 
 
+class Migrate(Command):
+    """Class used to represents the migrate Command which saves the
+    password database using another format or serializer."""
+    name = "migrate"
+    help = "Saves the database using another format or serializer."
+
+    def init(self, subparser):
+        Command.init(self, subparser)
+        subparser.add_argument("--format",
+                               choices=["yaml", "aes", "chunked"],
+                               help="The new format of the database.")
+        subparser.add_argument("-s", "--serializer",
+                               choices=["yaml", "records"],
+                               help="The new serializer of the entries.")
+        subparser.add_argument("-o", "--output", default=None,
+                               help="The new database file name " + \
+                               "(default is to replace the database).")
+
+    def action(self):
+        actions.migrate(self.conf, self.loader, self.args.format,
+                        self.args.serializer, self.args.output)
+
+
 class GUI(Command):
     """Class used to represents the gui Command which opens the GUI."""
 
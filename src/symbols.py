@@ -0,0 +1,192 @@
+#-*- coding: utf-8 -*-
+#
+# This file is part of PassMAN.
+#
+# PassMAN is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PassMAN is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PassMAN.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import mmap
+import struct
+import hashlib
+
+# Header of a compiled symbols file: magic string, number of symbols,
+# modification time, size and SHA-1 digest of the source file and
+# SHA-1 digest of the symbols (see get_digest).
+HEADER = struct.Struct("<8sIdQ20s20s")
+MAGIC = "PMSYM002"
+# Modification time and size of the source file in the header.
+STAT = struct.Struct("<dQ")
+STAT_OFFSET = struct.calcsize("<8sI")
+OFFSET = struct.Struct("<I")
+OFFSETS = struct.Struct("<2I")
+
+def read_source(filename):
+    """Returns the list of symbols of a source file containing a
+    symbol on each line. Empty lines are ignored."""
+    with open(filename) as f:
+        return [l.strip() for l in f.readlines() if len(l.strip()) > 0]
+
+def file_digest(filename):
+    """Returns the SHA-1 digest of the content of a file."""
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(65536), ""):
+            sha1.update(block)
+    return sha1.digest()
+
+def get_digest(symbols):
+    """Returns the SHA-1 digest of a sequence of symbols. It only
+    depends of the symbols and their order (and not of the empty
+    lines or spaces of the source file)."""
+    if isinstance(symbols, SymbolTable):
+        return symbols.digest
+    return hashlib.sha1("\n".join(symbols)).digest()
+
+def compiled_filename(filename):
+    """Returns the filename of the compiled symbols file of a source
+    file."""
+    return filename + ".sym"
+
+def write_file(filename, chunks):
+    """Writes chunks of data in a temporary file which then replaces
+    filename, so that a process which has mapped filename in memory
+    keeps reading its previous content."""
+    tmp_filename = "{}.{}.tmp".format(filename, os.getpid())
+    try:
+        with open(tmp_filename, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.rename(tmp_filename, filename)
+    except (IOError, OSError):
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+
+def compile_symbols(filename, out_filename):
+    """Compiles the source symbols file into out_filename. The
+    compiled file contains a header, an array of offsets (one more
+    than the number of symbols) and a blob with all the symbols. It
+    is first written in a temporary file which then replaces
+    out_filename."""
+    stat = os.stat(filename)
+    symbols = read_source(filename)
+    offsets = [0]
+    for s in symbols:
+        offsets.append(offsets[-1] + len(s))
+    write_file(out_filename,
+               [HEADER.pack(MAGIC, len(symbols), stat.st_mtime,
+                            stat.st_size, file_digest(filename),
+                            get_digest(symbols)),
+                struct.pack("<{}I".format(len(offsets)), *offsets),
+                "".join(symbols)])
+
+class SymbolTable(object):
+    """A SymbolTable is a read-only sequence of symbols backed by a
+    memory-mapped compiled symbols file. Symbols are only read from
+    the file when they are accessed."""
+
+    def __init__(self, filename):
+        """Maps the compiled symbols file in memory. Raises a
+        ValueError if the file is not a compiled symbols file."""
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            # Time at which the header was written.
+            self.written = os.fstat(f.fileno()).st_mtime
+        if len(self.data) < HEADER.size:
+            raise ValueError("Invalid compiled symbols file")
+        header = HEADER.unpack_from(self.data)
+        magic, self.count, self.mtime, self.size = header[:4]
+        self.source_digest, self.digest = header[4:]
+        if magic != MAGIC:
+            raise ValueError("Invalid compiled symbols file")
+        self.offsets = HEADER.size
+        self.blob = self.offsets + OFFSET.size * (self.count + 1)
+
+    def is_up_to_date(self, filename):
+        """Returns True if the table has been compiled from the
+        current version of the source file. The modification time and
+        size are checked first and the content is only hashed if they
+        don't match. If the content matches, they are updated so that
+        it isn't hashed again.
+
+        The modification time is ambiguous if it isn't older than the
+        header (the source may have been modified again within the
+        granularity of the modification times without changing its
+        size): the content is then hashed as well."""
+        stat = os.stat(filename)
+        if stat.st_mtime == self.mtime and stat.st_size == self.size and \
+           self.mtime < self.written:
+            return True
+        if file_digest(filename) != self.source_digest:
+            return False
+        self.update_stat(stat)
+        return True
+
+    def update_stat(self, stat):
+        """Writes the modification time and size of the source file in
+        the header of a copy of the compiled file which then replaces
+        it (see write_file). It is left unchanged if it can't be
+        written."""
+        self.mtime, self.size = stat.st_mtime, stat.st_size
+        try:
+            write_file(self.filename,
+                       [self.data[:STAT_OFFSET],
+                        STAT.pack(self.mtime, self.size),
+                        self.data[STAT_OFFSET + STAT.size:]])
+            self.written = os.stat(self.filename).st_mtime
+        except (IOError, OSError):
+            pass
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if i < 0 or i >= self.count:
+            raise IndexError("symbol index out of range")
+        start, end = OFFSETS.unpack_from(self.data,
+                                         self.offsets + OFFSET.size * i)
+        return self.data[self.blob + start:self.blob + end]
+
+    def __iter__(self):
+        for i in xrange(self.count):
+            yield self[i]
+
+    def __eq__(self, other):
+        if isinstance(other, SymbolTable):
+            return self.digest == other.digest
+        return list(self) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+def load(filename):
+    """Returns the symbols of a source file. The symbols are read from
+    a SymbolTable compiled next to the source file, which is
+    (re)compiled if needed. A list is returned if the compiled file
+    can't be written."""
+    out_filename = compiled_filename(filename)
+    try:
+        table = SymbolTable(out_filename)
+        if table.is_up_to_date(filename):
+            return table
+    except (IOError, OSError, ValueError, struct.error):
+        pass
+    try:
+        compile_symbols(filename, out_filename)
+        return SymbolTable(out_filename)
+    except (IOError, OSError, mmap.error):
+        return read_source(filename)
@@ -0,0 +1,102 @@
+#-*- coding: utf-8 -*-
+#
+# This file is part of PassMAN.
+#
+# PassMAN is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PassMAN is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PassMAN.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest, os
+import symbols
+
+class TestSymbolTable(unittest.TestCase):
+    def setUp(self):
+        self.words = ["w{}".format(i) for i in xrange(300)]
+        with open("test_words", 'w') as f:
+            f.write("\n".join(self.words + ["", "  "]))
+
+    def tearDown(self):
+        os.remove("test_words")
+        if os.path.exists("test_words.sym"):
+            os.remove("test_words.sym")
+
+    def test_load(self):
+        table = symbols.load("test_words")
+        self.assertTrue(isinstance(table, symbols.SymbolTable))
+        self.assertTrue(os.path.exists("test_words.sym"))
+        self.assertEqual(len(table), 300)
+        self.assertEqual(table[0], "w0")
+        self.assertEqual(table[299], "w299")
+        self.assertEqual(table[-1], "w299")
+        self.assertRaises(IndexError, table.__getitem__, 300)
+        self.assertEqual(list(table), self.words)
+        self.assertEqual(table, self.words)
+        self.assertEqual(table, symbols.load("test_words"))
+
+    def test_digest(self):
+        table = symbols.load("test_words")
+        self.assertEqual(symbols.get_digest(table),
+                         symbols.get_digest(self.words))
+        self.assertNotEqual(symbols.get_digest(table),
+                            symbols.get_digest(self.words[1:]))
+
+    def test_recompile(self):
+        symbols.load("test_words")
+        with open("test_words", 'w') as f:
+            f.write("\n".join(["a", "b", "c"]))
+        table = symbols.load("test_words")
+        self.assertEqual(list(table), ["a", "b", "c"])
+
+    def test_touch(self):
+        symbols.load("test_words")
+        os.utime("test_words", (0, 0))
+        table = symbols.SymbolTable("test_words.sym")
+        self.assertTrue(table.is_up_to_date("test_words"))
+        table = symbols.SymbolTable("test_words.sym")
+        self.assertEqual((table.mtime, table.size),
+                         (0, os.path.getsize("test_words")))
+        self.assertEqual(list(table), self.words)
+
+    def test_same_stat(self):
+        mtime = int(os.path.getmtime("test_words"))
+        os.utime("test_words", (mtime, mtime))
+        symbols.load("test_words")
+        # The source is modified again with the same size and
+        # modification time in the second it has been compiled.
+        with open("test_words", 'w') as f:
+            f.write("\n".join(["w1", "w0"] + self.words[2:] + ["", "  "]))
+        os.utime("test_words", (mtime, mtime))
+        os.utime("test_words.sym", (mtime, mtime))
+        table = symbols.load("test_words")
+        self.assertEqual(list(table), ["w1", "w0"] + self.words[2:])
+
+    def test_update_stat(self):
+        table = symbols.load("test_words")
+        os.utime("test_words", (0, 0))
+        # The file mapped by the table isn't modified.
+        with open("test_words.sym", 'rb') as f:
+            data = f.read()
+        self.assertTrue(table.is_up_to_date("test_words"))
+        self.assertEqual(table.data[:], data)
+        self.assertEqual(table.mtime, 0)
+        self.assertTrue(table.written > 0)
+        self.assertEqual(symbols.SymbolTable("test_words.sym").mtime, 0)
+        self.assertFalse([f for f in os.listdir(".") if f.endswith(".tmp")])
+
+    def test_invalid(self):
+        with open("test_words.sym", 'w') as f:
+            f.write("invalid")
+        table = symbols.load("test_words")
+        self.assertEqual(list(table), self.words)
+
+if __name__ == '__main__':
+    unittest.main()